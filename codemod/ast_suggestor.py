@@ -0,0 +1,292 @@
+"""
+A suggestor for structural Python refactors, which hands your code the parsed
+syntax tree of each file instead of its lines.  Which node types each source
+contains is cached on disk by the hash of the source (and the interpreter
+version), so running again over an unchanged tree only parses the files that
+have nodes of the types you're looking for.
+"""
+import ast
+import hashlib
+import multiprocessing
+import os
+import sys
+from collections import OrderedDict
+
+from codemod.fileview import file_view_suggestor
+from codemod.patch import Patch
+
+DEFAULT_CACHE_DIRECTORY = '.codemod.ast-cache'
+
+
+class ParseCache(object):
+    """
+    Parses Python source, keeping the last few parse trees in memory, and
+    recording on disk (in a small text file per distinct source) whether
+    each source parses and which node types its tree contains.  Trees
+    themselves aren't stored on disk, since loading one is slower than
+    parsing the source again.
+
+    >>> import shutil, tempfile
+    >>> cache = ParseCache(tempfile.mkdtemp())
+    >>> cache.parse('x = 1\\n').body[0].lineno
+    1
+    >>> cache.misses, cache.parse('x = 1\\n') is not None, cache.misses
+    (1, True, 1)
+    >>> cache.parse('x = ') is None
+    True
+    >>> cache.parse(b'# \\xc3\\xa9\\nx = 1\\n').body[0].lineno
+    2
+
+    A new cache (e.g. in the next run) knows what's in them without parsing:
+
+    >>> cache = ParseCache(cache.directory)
+    >>> cache.might_contain('x = 1\\n', ast.stmt)
+    True
+    >>> cache.might_contain('x = 1\\n', (ast.Call, ast.ClassDef))
+    False
+    >>> cache.might_contain('x = ', ast.Name), cache.misses
+    (False, 0)
+    >>> shutil.rmtree(cache.directory)
+
+    With record_summaries=False it only keeps trees in memory:
+
+    >>> cache = ParseCache(tempfile.mkdtemp(), record_summaries=False)
+    >>> cache.parse('x = 1\\n') is not None, os.listdir(cache.directory)
+    (True, [])
+    >>> shutil.rmtree(cache.directory)
+    """
+
+    def __init__(self, directory=DEFAULT_CACHE_DIRECTORY, trees_in_memory=8,
+                 record_summaries=True):
+        self.directory = directory
+        self.misses = 0
+        self.record_summaries = record_summaries
+        self._trees = OrderedDict()  # digest -> tree, most recent last
+        self._trees_in_memory = trees_in_memory
+
+    def _digest(self, source):
+        digest = hashlib.sha1(sys.version.encode('utf-8'))
+        digest.update(b'\0')
+        digest.update(
+            source if isinstance(source, bytes) else source.encode('utf-8'))
+        return digest.hexdigest()
+
+    def _summary_path(self, digest):
+        return os.path.join(self.directory, digest)
+
+    def parse(self, source):
+        """
+        Returns the parse tree of `source`, or None if it isn't valid Python.
+        """
+        digest = self._digest(source)
+        if digest in self._trees:
+            tree = self._trees.pop(digest)
+            self._trees[digest] = tree
+            return tree
+
+        self.misses += 1
+        try:
+            tree = ast.parse(source)
+        except (SyntaxError, ValueError):
+            tree = None
+        self._trees[digest] = tree
+        if len(self._trees) > self._trees_in_memory:
+            self._trees.popitem(last=False)
+        if (self.record_summaries and
+                not os.path.exists(self._summary_path(digest))):
+            self._save_summary(digest, tree)
+        return tree
+
+    def has_summary(self, source):
+        """True if what `source` contains has been recorded."""
+        return os.path.exists(self._summary_path(self._digest(source)))
+
+    def might_contain(self, source, node_types):
+        """
+        Returns False if `source` is known not to parse, or to contain no
+        nodes of `node_types` (a class or tuple of classes from the ast
+        module), without parsing it.
+        """
+        try:
+            with open(self._summary_path(self._digest(source))) as summary:
+                status = summary.readline().strip()
+                names = set(summary.readline().split())
+        except (IOError, UnicodeDecodeError):
+            return True  # never recorded
+        if status == 'error':
+            return False
+        if status != 'ok':
+            return True
+        if not isinstance(node_types, tuple):
+            node_types = (node_types,)
+        return any(node_type.__name__ in names for node_type in node_types)
+
+    def _save_summary(self, digest, tree):
+        """
+        Records what `tree` contains, including the base classes of its nodes
+        (such as ast.expr), so isinstance checks can be answered.  Failing to
+        save it only means the source is parsed again next time.
+        """
+        import tempfile
+        if tree is None:
+            text = 'error\n'
+        else:
+            names = set()
+            for node in ast.walk(tree):
+                for node_type in type(node).__mro__:
+                    if issubclass(node_type, ast.AST):
+                        names.add(node_type.__name__)
+            text = 'ok\n%s\n' % ' '.join(sorted(names))
+        try:
+            if not os.path.isdir(self.directory):
+                try:
+                    os.makedirs(self.directory)
+                except OSError:
+                    pass  # someone else made it
+            file_fd, temporary_path = tempfile.mkstemp(
+                prefix='.codemod-', dir=self.directory)
+            with os.fdopen(file_fd, 'w') as summary:
+                summary.write(text)
+            os.rename(temporary_path, self._summary_path(digest))
+        except (IOError, OSError):
+            pass
+
+
+def _parse_file(path_and_directory):
+    """Records what one file contains.  Runs in a worker process."""
+    path, directory = path_and_directory
+    try:
+        with open(path) as file_r:
+            source = file_r.read()
+    except (IOError, UnicodeDecodeError):
+        return
+    ParseCache(directory).parse(source)
+
+
+def python_ast_suggestor(node_transformation, node_types=None,
+                         cache_directory=DEFAULT_CACHE_DIRECTORY,
+                         processes=None):
+    """
+    Returns a suggestor that parses each file as Python and calls
+    `node_transformation` on its nodes, in source order.
+
+    @param node_transformation  Function that, given a node and the file's
+                                lines, returns None (no suggestion), the
+                                text (or list of lines) with which to replace
+                                the node's lines, i.e. lines node.lineno - 1
+                                up to node.end_lineno, or a Patch for any
+                                other range.  Nodes inside a node that got a
+                                patch are skipped.
+    @param node_types           A class or tuple of classes from the ast
+                                module.  If given, only nodes of these types
+                                are passed to node_transformation.
+    @param cache_directory      Where to record which node types each
+                                source contains (only with node_types).
+                                Files known to have none are never parsed.
+    @param processes            How many processes to parse new files with
+                                before the scan starts (only with
+                                node_types).  Defaults to one per CPU.
+
+    >>> def rename(node, lines):
+    ...     if node.name == 'old':
+    ...         line = lines[node.lineno - 1]
+    ...         return Patch(node.lineno - 1, new_lines=[
+    ...             line.replace('def old', 'def new')])
+    >>> import shutil, tempfile
+    >>> suggestor = python_ast_suggestor(
+    ...     rename, ast.FunctionDef, cache_directory=tempfile.mkdtemp())
+    >>> list(suggestor(['def old():\\n', '    old = 1\\n']))
+    [Patch(None, 0, 1, ['def new():\\n'])]
+    >>> shutil.rmtree(suggestor.cache.directory)
+    """
+    # Without node_types every file is parsed anyway, so what each contains
+    # isn't worth writing down.
+    cache = ParseCache(
+        cache_directory, record_summaries=node_types is not None)
+
+    @file_view_suggestor
+    def suggestor(view):
+        handled_line_number = 0  # lines before this have had their turn
+        while True:
+            source = view.text
+            if (node_types is not None and
+                    not cache.might_contain(source, node_types)):
+                return
+            tree = cache.parse(source)
+            if tree is None:
+                return
+            for node in _walk_in_order(tree, node_types):
+                start_line_number = node.lineno - 1
+                if start_line_number < handled_line_number:
+                    continue
+                result = node_transformation(node, view.lines)
+                if result is None:
+                    continue
+                if isinstance(result, Patch):
+                    patch = result
+                else:
+                    patch = Patch(
+                        start_line_number,
+                        getattr(node, 'end_lineno', None) or node.lineno,
+                        result
+                    )
+                line_count = len(view)
+                yield patch
+
+                handled_line_number = patch.end_line_number
+                if view.text != source:
+                    # Our caller updates the view after each patch, so
+                    # parse it again and carry on after this patch.
+                    handled_line_number += len(view) - line_count
+                    break
+            else:
+                return
+
+    def prepare(paths):
+        """
+        Parses the files at `paths` whose contents haven't been seen before,
+        in parallel, to record which node types they contain.
+        """
+        if node_types is None:
+            return  # every file has to be parsed during the scan anyway
+        jobs = [
+            (path, cache_directory) for path in paths
+            if not _has_summary(cache, path)
+        ]
+        if processes == 1 or len(jobs) < 2:
+            for job in jobs:
+                _parse_file(job)
+            return
+        pool = multiprocessing.Pool(processes)
+        try:
+            pool.map(_parse_file, jobs, chunksize=16)
+        finally:
+            pool.close()
+            pool.join()
+
+    suggestor.prepare = prepare
+    suggestor.cache = cache
+    return suggestor
+
+
+def _has_summary(cache, path):
+    try:
+        with open(path) as file_r:
+            return cache.has_summary(file_r.read())
+    except (IOError, UnicodeDecodeError):
+        return True  # nothing to parse
+
+
+def _walk_in_order(tree, node_types=None):
+    """
+    >>> tree = ast.parse('def f():\\n    return g(x)\\n')
+    >>> [type(node).__name__ for node in _walk_in_order(tree, ast.expr)]
+    ['Call', 'Name', 'Name']
+    """
+    nodes = [
+        node for node in ast.walk(tree)
+        if hasattr(node, 'lineno') and
+        (node_types is None or isinstance(node, node_types))
+    ]
+    nodes.sort(key=lambda node: (node.lineno, node.col_offset))
+    return nodes
@@ -20,25 +20,49 @@
 
 from __future__ import print_function
 
-import argparse
+import atexit
+import itertools
 import os
 import re
 import sys
-import textwrap
+from collections import OrderedDict
 from math import ceil
 
+from codemod.fileview import file_view_suggestor
 from codemod.patch import Patch
 from codemod.position import Position
 from codemod.query import Query
 import codemod.helpers as helpers
 import codemod.terminal_helper as terminal
+from codemod.writer import WriteBehind, replace_file
 
 yes_to_all = False
+# Files bigger than this many bytes are never read into memory; accepted
+# patches to them are held in _pending_stream_saves (path -> patches) until
+# codemod moves on to another file, and then written in one pass.
+_stream_threshold = None
+_pending_stream_saves = OrderedDict()
+# With a binary query, files are read and written as bytes, and only decoded
+# to be shown.
+_binary = False
+# With a decision log, the keys (see _decision_key) of the patches rejected
+# in this and earlier sessions.
+_decision_log = None
+_rejected_keys = set()
+# The files changed by this session (path -> the patches applied to it), for
+# validation.
+modified_files = OrderedDict()
+# Accepted patches are saved in the background; _writer is flushed before
+# anything else (the editor, a validator, another process) looks at the files.
+_writer = WriteBehind()
+atexit.register(_writer.flush)
 if sys.version_info[0] >= 3:
     unicode = str
 
 
-def run_interactive(query, editor=None, just_count=False, default_no=False):
+def run_interactive(query, editor=None, just_count=False, default_no=False,
+                    group_identical=False, batch_edit=False,
+                    decision_log=None, validator=None, validation_jobs=None):
     """
     Asks the user about each patch suggested by the result of the query.
 
@@ -49,11 +73,52 @@ def run_interactive(query, editor=None, just_count=False, default_no=False):
                         environment variable.
     @param just_count   If true: don't run normally.  Just print out number of
                         places in the codebase where the query matches.
+    @param group_identical  If true: find every match up front, and ask about
+                            each distinct change once, applying it everywhere
+                            it occurs if accepted.  Can't be used with a work
+                            queue, since finding every match would claim
+                            every file.
+    @param batch_edit       If true: rather than opening the editor for each
+                            patch you choose to edit, list them all in one
+                            quickfix file, open the editor once on it at the
+                            end, and then ask about whatever the suggestor
+                            still finds in the files you changed.
+    @param decision_log     Path of a file in which to remember the patches
+                            you reject, so that running the same query again
+                            doesn't ask about them again.
+    @param validator        A function that, given the path of a file this
+                            session changed, returns None if it's fine or an
+                            error message if not (see codemod.validate).  If
+                            given, it's run over every changed file at the
+                            end, and the failures are returned as a list of
+                            (path, message) pairs.
+    @param validation_jobs  How many files to validate at once.  Defaults to
+                            the number of CPUs.
     """
-    global yes_to_all
+    global yes_to_all, _stream_threshold, _decision_log, _binary
 
-    # Load start from bookmark, if appropriate.
-    bookmark = _load_bookmark()
+    if query.work_queue is not None and group_identical:
+        raise ValueError(
+            'group_identical would claim (and finish) every file in the '
+            'work queue before asking about any of them')
+    if just_count:
+        # Counting shouldn't claim anything, or leave a status line among
+        # the counts.
+        query = query.clone()
+        query.work_queue = None
+        query.progress = None
+    _stream_threshold = query.stream_threshold
+    _binary = _writer.binary = query.binary
+    _decision_log = decision_log
+    modified_files.clear()
+    if query.writer is None:
+        query.writer = _writer
+    if decision_log is not None:
+        _load_decision_log()
+
+    # Load start from bookmark, if appropriate.  (With a work queue, the
+    # queue remembers which files are done.)
+    bookmark = _load_bookmark() if query.work_queue is None else None
     if bookmark:
         print('Resume where you left off, at %s (y/n)? '
               % str(bookmark), end=' ')
@@ -74,11 +139,26 @@ def run_interactive(query, editor=None, just_count=False, default_no=False):
         print()
         return
 
-    for patch in suggestions:
-        _save_bookmark(patch.start_position)
-        _ask_about_patch(patch, editor, default_no)
-        print('Searching...')
+    edit_queue = [] if batch_edit else None
+    if group_identical:
+        _ask_about_patch_groups(
+            list(suggestions), editor, default_no, edit_queue)
+    else:
+        for patch in suggestions:
+            if query.work_queue is None:
+                _save_bookmark(patch.start_position)
+            _ask_about_patch(patch, editor, default_no, edit_queue)
+            print('Searching...')
+    _flush_stream_saves()
     _delete_bookmark()
+    while edit_queue:
+        touched_paths = _run_batch_editor(edit_queue, editor)
+        del edit_queue[:]
+        print('Searching %d edited files...' % len(touched_paths))
+        for patch in query.rescan(touched_paths):
+            _ask_about_patch(patch, editor, default_no, edit_queue)
+        _flush_stream_saves()
+    _writer.flush()
     if yes_to_all:
         terminal.terminal_clear()
         print(
@@ -87,9 +167,12 @@ def run_interactive(query, editor=None, just_count=False, default_no=False):
             "Make sure you and other people review the changes.\n\n"
             "With great power, comes great responsibility."
         )
+    if validator is not None:
+        return _validate_modified_files(validator, validation_jobs)
 
 
-def line_transformation_suggestor(line_transformation, line_filter=None):
+def line_transformation_suggestor(line_transformation, line_filter=None,
+                                  cache_size=None):
     """
     Returns a suggestor (a function that takes a list of lines and yields
     patches) where suggestions are the result of line-by-line transformations.
@@ -106,7 +189,18 @@ def line_transformation_suggestor(line_transformation, line_filter=None):
     @param line_filter          Given a line, returns True or False.  If False,
                                 a line is ignored (as if line_transformation
                                 returned the line itself for that line).
+    @param cache_size           If given, remember the results of
+                                line_transformation for up to this many
+                                distinct lines (see
+                                helpers.MemoizedLineTransformation).  Only use
+                                this if line_transformation depends on nothing
+                                but the line it is given.
     """
+    if cache_size:
+        line_transformation = helpers.MemoizedLineTransformation(
+            line_transformation, cache_size
+        )
+
     def suggestor(lines):
         for line_number, line in enumerate(lines):
             if line_filter and not line_filter(line):
@@ -116,12 +210,62 @@ def line_transformation_suggestor(line_transformation, line_filter=None):
                 yield Patch(line_number)
             else:
                 yield Patch(line_number, new_lines=[candidate])
+    suggestor.line_transformation = line_transformation
+    suggestor.stream = lambda lines: _stream_in_chunks(suggestor, lines)
     return suggestor
 
 
+def _stream_in_chunks(suggestor, lines, chunk_size=65536):
+    r"""
+    Feeds an iterable of lines (e.g. an open file) to a suggestor whose
+    patches never span more than one line, `chunk_size` lines at a time.
+    Patches are numbered from the start of `lines`, carry their old_lines,
+    and are only yielded if they suggest a change.
+
+    >>> suggestor = regex_suggestor('b', 'B')
+    >>> for patch in _stream_in_chunks(suggestor, ['a\n', 'b\n', 'cb\n'], 2):
+    ...     print('%r %r' % (patch, patch.old_lines))
+    Patch(None, 1, 2, ['B\n']) ['b\n']
+    Patch(None, 2, 3, ['cB\n']) ['cb\n']
+    """
+    lines = iter(lines)
+    offset = 0
+    while True:
+        chunk = list(itertools.islice(lines, chunk_size))
+        if not chunk:
+            return
+        for patch in suggestor(chunk):
+            old_lines = chunk[patch.start_line_number:patch.end_line_number]
+            if patch.new_lines is not None and patch.new_lines == old_lines:
+                continue
+            patch.old_lines = old_lines
+            patch.start_line_number += offset
+            patch.end_line_number += offset
+            yield patch
+        offset += len(chunk)
+
+
 def regex_suggestor(regex, substitution=None, ignore_case=False,
-                    line_filter=None):
-    if isinstance(regex, str):
+                    line_filter=None, cache_size=None):
+    r"""
+    Return a suggestor function which applies the given regex to one line at a
+    time.
+
+    Rather than searching each line separately, the suggestor searches the
+    whole file at once and only looks at the lines where the regex can match,
+    falling back to a line-by-line search for regexes whose meaning could
+    change when they see the neighbouring lines (lookbehinds, negative
+    lookaheads, \A, \Z, \B and DOTALL).
+
+    >>> suggestor = regex_suggestor('b+', 'B')
+    >>> list(suggestor(['abba\n', 'cd\n', 'bob\n']))
+    [Patch(None, 0, 1, ['aBa\n']), Patch(None, 2, 3, ['BoB\n'])]
+    >>> list(suggestor(['ab\n', 'bc']))
+    [Patch(None, 0, 1, ['aB\n']), Patch(None, 1, 2, ['Bc'])]
+    >>> list(regex_suggestor('x$')(['ax\n', 'b\n', 'cx']))
+    [Patch(None, 0, 1, None), Patch(None, 2, 3, None)]
+    """
+    if isinstance(regex, (str, bytes)):
         if ignore_case is False:
             regex = re.compile(regex)
         else:
@@ -133,7 +277,99 @@ def regex_suggestor(regex, substitution=None, ignore_case=False,
     else:
         def line_transformation(line):
             return regex.sub(substitution, line)
-    return line_transformation_suggestor(line_transformation, line_filter)
+    line_suggestor = line_transformation_suggestor(
+        line_transformation, line_filter, cache_size
+    )
+    # Lets Query narrow down the files it reads (see codemod.index).
+    line_suggestor.regex = regex
+    if not _can_search_whole_buffer(regex):
+        return line_suggestor
+
+    line_transformation = line_suggestor.line_transformation
+    buffer_regex = re.compile(regex.pattern, regex.flags | re.MULTILINE)
+
+    @file_view_suggestor
+    def suggestor(view):
+        if not view.newline_terminated:
+            # Searching lines that don't end in newlines as one text would
+            # let matches run across them.
+            for patch in line_suggestor(view.lines):
+                yield patch
+            return
+
+        text = view.text
+        newline = view.newline
+        pos = 0
+        while True:
+            match = buffer_regex.search(text, pos)
+            if match is None:
+                break
+            if match.start() == len(text) and (
+                    not text or text.endswith(newline)):
+                break  # empty match after the last line
+            line_number, column = view.offset_to_position(match.start())
+            line_start = match.start() - column
+            line_end = text.find(newline, match.start()) + 1 or len(text)
+            line = text[line_start:line_end]
+
+            # The buffer match is only a hint; the line's own transformation
+            # decides, so a match running into the next line never counts.
+            if not line_filter or line_filter(line):
+                candidate = line_transformation(line)
+                if candidate is None or candidate != line:
+                    yield Patch(line_number, new_lines=(
+                        None if candidate is None else [candidate]
+                    ))
+                    # Our caller updates the view after each patch.
+                    if view.text != text:
+                        text = view.text
+                        if line_number + 1 >= len(view):
+                            break
+                        line_end = view.position_to_offset(
+                            line_number + 1, 0)
+
+            if line_end >= len(text):
+                break
+            pos = line_end
+
+    suggestor.line_transformation = line_transformation
+    suggestor.regex = regex
+    suggestor.stream = lambda lines: _stream_in_chunks(suggestor, lines)
+    return suggestor
+
+
+def _can_search_whole_buffer(regex):
+    r"""
+    Returns True if matching `regex` against a whole file (with MULTILINE)
+    finds a hit on every line that matching it line by line would.
+
+    >>> _can_search_whole_buffer(re.compile(r'^foo\(\w+\)$'))
+    True
+    >>> _can_search_whole_buffer(re.compile(r'(?<!\s)foo'))
+    False
+    >>> _can_search_whole_buffer(re.compile(r'foo(?!\s*bar)'))
+    False
+    >>> _can_search_whole_buffer(re.compile(r'(?s)a.b'))
+    False
+    >>> _can_search_whole_buffer(re.compile(r'\s$'))
+    False
+    """
+    if regex.flags & re.DOTALL:
+        return False
+    pattern = regex.pattern
+    if not isinstance(pattern, str):
+        pattern = pattern.decode('latin-1')
+    if any(token in pattern
+           for token in ('(?<', '(?!', '\\A', '\\Z', '\\B')):
+        return False
+    # Line by line, $ also matches after a line's trailing newline; in the
+    # whole buffer that is the start of the next line.
+    if '$' in pattern:
+        return not any(token in pattern for token in (
+            '\n', '\\n', '\\s', '\\W', '\\D', '\\x', '\\u', '\\0',
+            '[^'
+        ))
+    return True
 
 
 def multiline_regex_suggestor(regex, substitution=None, ignore_case=False):
@@ -148,26 +384,28 @@ def multiline_regex_suggestor(regex, substitution=None, ignore_case=False):
                          \1 notation to backreference match groups) or a
                          function (that takes a match object as input).
     """
-    if isinstance(regex, str):
+    if isinstance(regex, (str, bytes)):
         if ignore_case is False:
             regex = re.compile(regex, re.DOTALL | re.MULTILINE)
         else:
             regex = re.compile(regex, re.DOTALL | re.MULTILINE | re.IGNORECASE)
 
-    if isinstance(substitution, str):
+    if isinstance(substitution, (str, bytes)):
         def substitution_func(match):
             return match.expand(substitution)
     else:
         substitution_func = substitution
 
-    def suggestor(lines):
+    @file_view_suggestor
+    def suggestor(view):
         pos = 0
         while True:
-            match = regex.search(''.join(lines), pos)
+            text = view.text
+            match = regex.search(text, pos)
             if not match:
                 break
-            start_row, start_col = _index_to_row_col(lines, match.start())
-            end_row, end_col = _index_to_row_col(lines, match.end() - 1)
+            start_row, start_col = view.offset_to_position(match.start())
+            end_row = view.offset_to_position(match.end() - 1)[0]
 
             if substitution is None:
                 new_lines = None
@@ -177,10 +415,12 @@ def multiline_regex_suggestor(regex, substitution=None, ignore_case=False):
                 # character-level patches, rather than line-level patches.
                 new_lines = substitution_func(match)
                 if new_lines is not None:
-                    new_lines = ''.join((
-                        lines[start_row][:start_col],
+                    new_lines = text[:0].join((
+                        text[match.start() - start_col:match.start()],
                         new_lines,
-                        lines[end_row][end_col + 1:]
+                        text[match.end():
+                             text.find(view.newline, match.end() - 1) + 1 or
+                             None]
                     ))
 
             yield Patch(
@@ -191,31 +431,13 @@ def multiline_regex_suggestor(regex, substitution=None, ignore_case=False):
             delta = 1 if new_lines is None else min(1, len(new_lines))
             pos = match.start() + delta
 
+    suggestor.regex = regex
     return suggestor
 
 
-def _index_to_row_col(lines, index):
-    r"""
-    >>> lines = ['hello\n', 'world\n']
-    >>> _index_to_row_col(lines, 0)
-    (0, 0)
-    >>> _index_to_row_col(lines, 7)
-    (1, 1)
-    """
-    if index < 0:
-        raise IndexError('negative index')
-    current_index = 0
-    for line_number, line in enumerate(lines):
-        line_length = len(line)
-        if current_index + line_length > index:
-            return line_number, index - current_index
-        current_index += line_length
-    raise IndexError('index %d out of range' % index)
-
-
 def print_patch(patch, lines_to_print, file_lines=None):
     if file_lines is None:
-        file_lines = list(open(patch.path))
+        file_lines = _writer.read_lines(patch.path)
 
     size_of_old = patch.end_line_number - patch.start_line_number
     size_of_new = len(patch.new_lines) if patch.new_lines else 0
@@ -228,33 +450,66 @@ def print_patch(patch, lines_to_print, file_lines=None):
 
     def print_file_line(line_number):  # noqa
         # Why line_number is passed here?
-        print('  %s' % file_lines[i], end='') if (
+        print('  %s' % _displayable(file_lines[i]), end='') if (
             0 <= i < len(file_lines)) else '~\n',
 
     for i in range(start_context_line_number, patch.start_line_number):
         print_file_line(i)
     for i in range(patch.start_line_number, patch.end_line_number):
         if patch.new_lines is not None:
-            terminal.terminal_print('- %s' % file_lines[i], color='RED')
+            terminal.terminal_print(
+                '- %s' % _displayable(file_lines[i]), color='RED')
         else:
-            terminal.terminal_print('* %s' % file_lines[i], color='YELLOW')
+            terminal.terminal_print(
+                '* %s' % _displayable(file_lines[i]), color='YELLOW')
     if patch.new_lines is not None:
         for line in patch.new_lines:
-            terminal.terminal_print('+ %s' % line, color='GREEN')
+            terminal.terminal_print(
+                '+ %s' % _displayable(line), color='GREEN')
     for i in range(patch.end_line_number, end_context_line_number):
         print_file_line(i)
 
 
-def _ask_about_patch(patch, editor, default_no):
+def _displayable(line):
+    r"""
+    Returns a line read in binary mode as text that can be printed: decoded
+    as UTF-8 if it is, or else as Latin-1.  (On Python 2, where every line
+    is bytes and prints as it is, lines are returned unchanged.)
+
+    >>> python2 = bytes is str
+    >>> _displayable(b'caf\xc3\xa9\n') == (
+    ...     b'caf\xc3\xa9\n' if python2 else u'caf\xe9\n')
+    True
+    >>> _displayable(b'caf\xe9\n') == (
+    ...     b'caf\xe9\n' if python2 else u'caf\xe9\n')
+    True
+    """
+    if isinstance(line, bytes) and bytes is not str:
+        try:
+            return line.decode('utf-8')
+        except UnicodeDecodeError:
+            return line.decode('latin-1')
+    return line
+
+
+def _ask_about_patch(patch, editor, default_no, edit_queue=None):
     global yes_to_all
 
     default_action = 'n' if default_no else 'y'
+    size = list(terminal.terminal_get_size())
+    lines = _lines_around(patch, size[0])
+    streamed = isinstance(lines, _FileWindow)
+
+    decision_key = None
+    if _decision_log is not None:
+        decision_key = _decision_key(patch, lines)
+        if decision_key in _rejected_keys:
+            return 'n'
+
     terminal.terminal_clear()
     terminal.terminal_print('%s\n' % patch.render_range(), color='WHITE')
     print()
 
-    lines = list(open(patch.path))
-    size = list(terminal.terminal_get_size())
     print_patch(patch, size[0] - 20, lines)
 
     print()
@@ -277,13 +532,272 @@ def _ask_about_patch(patch, editor, default_no):
     if p in 'A':
         yes_to_all = True
         p = 'y'
+    if p in 'n' and decision_key is not None:
+        _record_rejection(decision_key)
     if p in 'yE':
-        patch.apply_to(lines)
-        _save(patch.path, lines)
+        if streamed:
+            for path in list(_pending_stream_saves):
+                if path != patch.path:
+                    _stream_save(path, _pending_stream_saves.pop(path))
+            _pending_stream_saves.setdefault(patch.path, []).append(patch)
+        else:
+            patch.apply_to(lines)
+            _save(patch.path, lines, [patch])
     if p in 'eE':
-        run_editor(patch.start_position, editor)
+        if edit_queue is None:
+            _flush_stream_saves()
+            _writer.flush()
+            run_editor(patch.start_position, editor)
+        else:
+            edit_queue.append(patch)
     if p in 'q':
+        _flush_stream_saves()
+        _writer.flush()
+        if edit_queue:
+            _run_batch_editor(edit_queue, editor)
         sys.exit(0)
+    return p
+
+
+#
+# Grouping functions.  With group_identical, codemod asks about each distinct
+# change once, rather than once per place it occurs.
+#
+
+def _group_patches(patches):
+    r"""
+    Returns lists of patches that make the same change (ignoring leading and
+    trailing whitespace), in order of first appearance.  Patches that don't
+    suggest a change are never grouped.
+
+    >>> patches = [Patch(0, None, ['x = 2\n'], 'a', ['x = 1\n']),
+    ...            Patch(1, None, ['  x = 2\n'], 'a', ['  x = 1\n']),
+    ...            Patch(0, None, None, 'b', ['y\n']),
+    ...            Patch(1, None, ['x = 2\n'], 'b', ['x = 1\n'])]
+    >>> [[p.render_range() for p in group]
+    ...  for group in _group_patches(patches)]
+    [['a:0', 'a:1', 'b:1'], ['b:0']]
+    """
+    groups = OrderedDict()
+    for patch in patches:
+        if patch.new_lines is None:
+            key = id(patch)
+        else:
+            key = (
+                tuple(line.strip() for line in patch.old_lines),
+                tuple(line.strip() for line in patch.new_lines)
+            )
+        groups.setdefault(key, []).append(patch)
+    return list(groups.values())
+
+
+def _shifted_patch(patch, shifts):
+    """
+    Returns a copy of `patch` moved down (or up) by the number of lines added
+    (or removed) by the patches recorded in `shifts` above it.
+
+    >>> _shifted_patch(Patch(5, 7, ['x'], 'a'), {'a': [(1, 2), (9, -1)]})
+    Patch('a', 7, 9, ['x'])
+    """
+    offset = sum(
+        delta for line_number, delta in shifts.get(patch.path, ())
+        if line_number < patch.start_line_number
+    )
+    return Patch(
+        patch.start_line_number + offset,
+        patch.end_line_number + offset,
+        patch.new_lines,
+        patch.path,
+        patch.old_lines
+    )
+
+
+def _lines_have_changed(patch, lines):
+    r"""
+    Returns True if the lines `patch` would replace in `lines` aren't the
+    ones it was suggested for, e.g. because an edit moved them.
+
+    >>> patch = Patch(1, None, ['b2\n'], 'a.txt', ['b1\n'])
+    >>> _lines_have_changed(patch, ['a2\n', 'b1\n', 'c1\n'])
+    False
+
+    After the first line was accepted and then given a line above it in the
+    editor (which shifts don't know about), the patch would hit 'a2':
+
+    >>> shifts = {}
+    >>> _record_shift(Patch(0, None, ['a2\n'], 'a.txt', ['a1\n']), shifts)
+    >>> _lines_have_changed(_shifted_patch(patch, shifts),
+    ...                     ['NEW\n', 'a2\n', 'b1\n', 'c1\n'])
+    True
+    """
+    if patch.old_lines is None:
+        return False
+    return lines[patch.start_line_number:
+                 patch.end_line_number] != patch.old_lines
+
+
+def _record_shift(patch, shifts):
+    # new_lines may hold several lines per item (e.g. from a substitution
+    # that inserts a newline).
+    new_lines = patch.new_lines
+    new_line_count = len(
+        new_lines[0][:0].join(new_lines).splitlines(True)
+    ) if new_lines else 0
+    delta = new_line_count - (patch.end_line_number - patch.start_line_number)
+    if delta:
+        shifts.setdefault(patch.path, []).append(
+            (patch.start_line_number, delta))
+
+
+def _apply_patch_group(group, shifts):
+    """
+    Applies every patch in `group`, writing each file once.  Returns the
+    number of patches skipped because their lines changed since the scan.
+    """
+    patches_by_path = OrderedDict()
+    for patch in group:
+        patches_by_path.setdefault(patch.path, []).append(patch)
+
+    skipped = 0
+    for path, patches in patches_by_path.items():
+        applied = []
+        if _should_stream(path):
+            # Written in the same pass as any accepted patches still
+            # waiting for this file.
+            queued = [_shifted_patch(patch, shifts) for patch in patches]
+            _stream_save(path, _pending_stream_saves.pop(path, []) + queued)
+            written = set(map(id, modified_files.get(path, ())))
+            for patch, shifted in zip(patches, queued):
+                if id(shifted) in written:
+                    _record_shift(patch, shifts)
+                else:
+                    skipped += 1
+            continue
+
+        lines = _writer.read_lines(path)
+        patches.sort(key=lambda patch: patch.start_line_number, reverse=True)
+        for patch in patches:
+            shifted = _shifted_patch(patch, shifts)
+            if _lines_have_changed(shifted, lines):
+                skipped += 1
+                continue
+            shifted.apply_to(lines)
+            _record_shift(patch, shifts)
+            applied.append(shifted)
+        _save(path, lines, applied)
+    return skipped
+
+
+def _ask_about_patch_groups(patches, editor, default_no, edit_queue=None,
+                            max_locations=10):
+    global yes_to_all
+
+    decision_keys = {}
+    if _decision_log is not None:
+        decision_keys = _decision_keys(patches)
+        patches = [patch for patch in patches
+                   if decision_keys[id(patch)] not in _rejected_keys]
+
+    # Lines added or removed so far, so patches found by the scan can be
+    # moved to where their lines are now.
+    shifts = {}
+    skipped = 0
+    # Patches accepted one at a time in a streamed file wait in
+    # _pending_stream_saves until codemod moves on to another file, so the
+    # file is rewritten once rather than once per patch.  Until they're
+    # written, the lines they add or remove don't move the file's other
+    # patches, so they're kept here (path -> [(patch as found by the scan,
+    # patch as queued)]) and their shifts recorded once they're written.
+    unwritten = {}
+
+    def record_written_shifts():
+        for path in list(unwritten):
+            if path not in _pending_stream_saves:
+                written = set(map(id, modified_files.get(path, ())))
+                for patch, queued in unwritten.pop(path):
+                    if id(queued) in written:
+                        _record_shift(patch, shifts)
+
+    def ask_about_one(patch):
+        """
+        Asks about a patch found by the scan, where its lines are now, unless
+        they've changed since (e.g. in the editor).  Returns the number
+        skipped.
+        """
+        for path in list(_pending_stream_saves):
+            if path != patch.path:
+                _stream_save(path, _pending_stream_saves.pop(path))
+        record_written_shifts()
+        shifted = _shifted_patch(patch, shifts)
+        streamed = _should_stream(shifted.path)
+        if not streamed and _lines_have_changed(
+                shifted, _writer.read_lines(shifted.path)):
+            return 1
+        if _ask_about_patch(shifted, editor, default_no, edit_queue) in 'yE':
+            if streamed:
+                unwritten.setdefault(patch.path, []).append((patch, shifted))
+                record_written_shifts()  # in case it was, e.g. for 'E'
+            else:
+                _record_shift(patch, shifts)
+        return 0
+
+    for group in _group_patches(patches):
+        sample = _shifted_patch(group[0], shifts)
+        if sample.new_lines is None or len(group) == 1:
+            skipped += ask_about_one(group[0])
+            continue
+
+        terminal.terminal_clear()
+        terminal.terminal_print(
+            '%d identical changes\n' % len(group), color='WHITE')
+        for patch in group[:max_locations]:
+            print('  %s' % _shifted_patch(patch, shifts).render_range())
+        if len(group) > max_locations:
+            print('  ... and %d more' % (len(group) - max_locations))
+        print()
+
+        size = list(terminal.terminal_get_size())
+        print_patch(sample, size[0] - 20 - min(len(group), max_locations + 1),
+                    _lines_around(sample, size[0]))
+        print()
+
+        if yes_to_all:
+            p = 'y'
+        else:
+            if default_no:
+                print('Accept all %d changes (y = yes, n = no [default], '
+                      's = step through them, A = yes to all, '
+                      'q = quit)? ' % len(group), end=' ')
+            else:
+                print('Accept all %d changes (y = yes [default], n = no, '
+                      's = step through them, A = yes to all, '
+                      'q = quit)? ' % len(group), end=' ')
+            p = _prompt('ynsAq', default='n' if default_no else 'y')
+
+        if p in 'A':
+            yes_to_all = True
+            p = 'y'
+        if p in 'n' and decision_keys:
+            for patch in group:
+                _record_rejection(decision_keys[id(patch)])
+        if p in 'y':
+            group_skipped = _apply_patch_group(group, shifts)
+            record_written_shifts()
+            if group_skipped:
+                print('Skipped %d changes whose lines have changed since '
+                      'the search.' % group_skipped)
+        if p in 's':
+            for patch in group:
+                skipped += ask_about_one(patch)
+        if p in 'q':
+            _flush_stream_saves()
+            _writer.flush()
+            if edit_queue:
+                _run_batch_editor(edit_queue, editor)
+            sys.exit(0)
+    if skipped:
+        print('Skipped %d changes whose lines have changed since the '
+              'search.' % skipped)
 
 
 def _prompt(letters='yn', default=None):
@@ -305,11 +819,134 @@ def _prompt(letters='yn', default=None):
         print('Come again?')
 
 
-def _save(path, lines):
-    file_w = open(path, 'w')
-    for line in lines:
-        file_w.write(line)
-    file_w.close()
+def _save(path, lines, patches=()):
+    _writer.write(path, lines)
+    modified_files.setdefault(path, []).extend(patches)
+
+
+#
+# Streaming functions.  Files bigger than the query's stream_threshold are
+# shown and rewritten a piece at a time, rather than read into memory.
+#
+
+def _should_stream(path):
+    if _stream_threshold is None:
+        return False
+    try:
+        return os.path.getsize(path) > _stream_threshold
+    except OSError:
+        return False
+
+
+def _lines_around(patch, line_count):
+    """
+    Returns the lines of the file `patch` is in, or if the file is too big to
+    read into memory, a _FileWindow of the lines within `line_count` of it.
+    """
+    if _should_stream(patch.path):
+        return _FileWindow(
+            patch.path,
+            max(0, patch.start_line_number - line_count),
+            patch.end_line_number + line_count
+        )
+    return _writer.read_lines(patch.path)
+
+
+class _FileWindow(object):
+    """
+    The lines of a file between two line numbers, looked up by their line
+    number in the whole file, for print_patch.
+    """
+
+    def __init__(self, path, start_line_number, end_line_number):
+        with open(path, 'rb' if _binary else 'r') as file_r:
+            self._lines = list(itertools.islice(
+                file_r, start_line_number, end_line_number))
+        self._start_line_number = start_line_number
+        if len(self._lines) < end_line_number - start_line_number:
+            self._length = start_line_number + len(self._lines)
+        else:
+            self._length = sys.maxsize  # we didn't look for the end
+
+    def __getitem__(self, line_number):
+        return self._lines[line_number - self._start_line_number]
+
+    def __len__(self):
+        return self._length
+
+
+def _stream_save(path, patches):
+    r"""
+    Applies `patches` to the file at `path` in one pass, writing a temporary
+    file next to it and renaming it into place.  Patches must carry their
+    old_lines; any whose lines no longer match (or that overlap an earlier
+    patch) are skipped.  Returns the number skipped.
+
+    >>> import shutil, tempfile
+    >>> directory = tempfile.mkdtemp()
+    >>> path = os.path.join(directory, 'big.txt')
+    >>> with open(path, 'w') as file_w:
+    ...     file_w.writelines(['a\n', 'b\n', 'c\n', 'd\n'])
+    >>> os.link(path, path + '.link')
+    >>> _stream_save(path, [
+    ...     Patch(2, 3, ['C\n'], path, ['c\n']),
+    ...     Patch(0, 2, ['A\n'], path, ['a\n', 'b\n']),
+    ...     Patch(1, 2, ['B\n'], path, ['b\n']),  # overlaps the one above
+    ...     Patch(3, 4, ['D\n'], path, ['x\n']),  # its lines have changed
+    ... ])
+    2
+    >>> open(path).read() == open(path + '.link').read() == 'A\nC\nd\n'
+    True
+    >>> del modified_files[path]
+    >>> shutil.rmtree(directory)
+    """
+    import tempfile
+    _writer.flush(path)
+    patches = sorted(patches, key=lambda patch: patch.start_line_number)
+    file_fd, temporary_path = tempfile.mkstemp(
+        prefix='.codemod-', dir=os.path.dirname(os.path.realpath(path)))
+    skipped = 0
+    applied = []
+    try:
+        with open(path, 'rb' if _binary else 'r') as file_r:
+            with os.fdopen(file_fd, 'wb' if _binary else 'w') as file_w:
+                line_number = 0
+                for patch in patches:
+                    if patch.start_line_number < line_number:
+                        skipped += 1  # overlaps the previous patch
+                        continue
+                    file_w.writelines(itertools.islice(
+                        file_r, patch.start_line_number - line_number))
+                    old_lines = list(itertools.islice(
+                        file_r,
+                        patch.end_line_number - patch.start_line_number))
+                    line_number = patch.end_line_number
+                    if old_lines == patch.old_lines:
+                        file_w.writelines(patch.new_lines)
+                        applied.append(patch)
+                    else:
+                        file_w.writelines(old_lines)
+                        skipped += 1
+                for line in file_r:
+                    file_w.write(line)
+        replace_file(temporary_path, path)
+    except BaseException:
+        os.remove(temporary_path)
+        raise
+    if applied:
+        modified_files.setdefault(path, []).extend(applied)
+    return skipped
+
+
+def _flush_stream_saves():
+    while _pending_stream_saves:
+        path, patches = _pending_stream_saves.popitem(last=False)
+        _stream_save(path, patches)
+
+
+# Registered after _writer.flush, so it runs first (e.g. after Ctrl-C), and
+# the patches accepted in the last streamed file aren't lost.
+atexit.register(_flush_stream_saves)
 
 
 def run_editor(position, editor=None):
@@ -317,6 +954,161 @@ def run_editor(position, editor=None):
     os.system('%s +%d %s' % (editor, position.line_number + 1, position.path))
 
 
+#
+# Batch editing functions.  With batch_edit, codemod collects the patches you
+# want to edit by hand and opens your editor once, on a quickfix (a.k.a.
+# compilation-mode) list of them.
+#
+
+def _run_batch_editor(patches, editor=None):
+    """
+    Opens the editor once on a quickfix list of `patches`, and returns the
+    paths of the files that changed while it was open.
+    """
+    _writer.flush()
+    paths = sorted(set(patch.path for patch in patches))
+    digests = dict((path, _file_digest(path)) for path in paths)
+
+    import tempfile
+    quickfix_fd, quickfix_path = tempfile.mkstemp(suffix='.codemod')
+    with os.fdopen(quickfix_fd, 'w') as quickfix_file:
+        quickfix_file.writelines(_quickfix_lines(patches))
+    try:
+        run_quickfix_editor(quickfix_path, editor)
+    finally:
+        os.remove(quickfix_path)
+
+    return [path for path in paths if _file_digest(path) != digests[path]]
+
+
+def _quickfix_lines(patches):
+    """
+    >>> list(_quickfix_lines([Patch(2, path='./a.php')]))
+    ['./a.php:3: codemod: edit ./a.php:2\\n']
+    """
+    for patch in patches:
+        yield '%s:%d: codemod: edit %s\n' % (
+            patch.path, patch.start_line_number + 1, patch.render_range())
+
+
+def _file_digest(path):
+    import hashlib
+    try:
+        with open(path, 'rb') as file_r:
+            return hashlib.md5(file_r.read()).hexdigest()
+    except IOError:
+        return None
+
+
+def run_quickfix_editor(quickfix_path, editor=None):
+    """
+    Opens the editor on a file of `path:line: message` lines, as a list of
+    places to jump between if the editor knows how (vim's -q, emacs's
+    compilation-mode), or as a plain file otherwise.
+    """
+    editor = editor or os.environ.get('EDITOR') or 'vim'
+    editor_name = os.path.basename(editor.split()[0])
+    if editor_name in ('vi', 'vim', 'nvim', 'gvim', 'mvim'):
+        os.system('%s -q %s' % (editor, quickfix_path))
+    elif editor_name == 'emacs':
+        os.system('%s %s -f compilation-mode' % (editor, quickfix_path))
+    else:
+        os.system('%s %s' % (editor, quickfix_path))
+
+
+#
+# Decision log functions.  With a decision log, codemod remembers each patch
+# you reject, keyed by its file, its change and the lines around it, and
+# doesn't ask about it again.
+#
+
+def _decision_key(patch, lines, context=2):
+    r"""
+    >>> lines = ['a\n', 'b\n', 'c\n', 'd\n']
+    >>> key = _decision_key(Patch(2, None, ['C\n'], 'x.php'), lines)
+    >>> key == _decision_key(Patch(3, None, ['C\n'], 'x.php'), ['z\n'] + lines)
+    True
+    >>> key == _decision_key(Patch(2, None, ['c\n'], 'x.php'), lines)
+    False
+    """
+    window_start = max(0, patch.start_line_number - context)
+    window_end = min(len(lines), patch.end_line_number + context)
+    import hashlib
+    parts = [
+        patch.path,
+        '%d:%d' % (patch.start_line_number - window_start,
+                   patch.end_line_number - patch.start_line_number)
+    ]
+    parts.extend(lines[i] for i in range(window_start, window_end))
+    parts.append('->')
+    if patch.new_lines is not None:
+        parts.extend(patch.new_lines)
+    return hashlib.sha1(b'\0'.join(
+        part if isinstance(part, bytes) else part.encode('utf-8')
+        for part in parts
+    )).hexdigest()
+
+
+def _decision_keys(patches):
+    """
+    Returns the decision keys of `patches`, by id(patch), reading each file
+    only once.
+    """
+    keys = {}
+    lines_path, lines = None, None
+    for patch in patches:
+        if _should_stream(patch.path):
+            keys[id(patch)] = _decision_key(patch, _FileWindow(
+                patch.path,
+                max(0, patch.start_line_number - 2),
+                patch.end_line_number + 2
+            ))
+            continue
+        if patch.path != lines_path:
+            lines_path, lines = patch.path, _writer.read_lines(patch.path)
+        keys[id(patch)] = _decision_key(patch, lines)
+    return keys
+
+
+def _load_decision_log():
+    _rejected_keys.clear()
+    try:
+        with open(_decision_log) as log_file:
+            _rejected_keys.update(line.strip() for line in log_file)
+    except IOError:
+        pass  # file doesn't exist yet
+
+
+def _record_rejection(decision_key):
+    _rejected_keys.add(decision_key)
+    with open(_decision_log, 'a') as log_file:
+        log_file.write(decision_key + '\n')
+
+
+def _validate_modified_files(validator, jobs=None):
+    """
+    Runs `validator` over the files changed this session, and reports each
+    failure along with the patches applied to that file.
+    """
+    if not modified_files:
+        return []
+    import codemod.validate as validate
+    print('Validating %d changed files...' % len(modified_files))
+    failures = validate.validate(list(modified_files), validator, jobs)
+    for path, message in failures:
+        terminal.terminal_print('%s failed validation:\n' % path, color='RED')
+        print(message)
+        for patch in modified_files[path]:
+            print('  caused by %s' % patch.render_range())
+            for line in patch.new_lines:
+                terminal.terminal_print(
+                    '  + %s' % _displayable(line), color='GREEN')
+        print()
+    if not failures:
+        print('All changed files passed validation.')
+    return failures
+
+
 #
 # Bookmarking functions.  codemod saves a file called .codemod.bookmark to
 # keep track of where you were the last time you exited in the middle of
@@ -351,6 +1143,10 @@ def _delete_bookmark():
 #
 
 def _parse_command_line():
+    # Imported here rather than at the top, like everything only some
+    # options need, to keep codemod quick to start.
+    import argparse
+    import textwrap
     global yes_to_all
 
     parser = argparse.ArgumentParser(
@@ -399,12 +1195,18 @@ def _parse_command_line():
                              '(e.g. have dot match newlines). '
                              'By default, codemod applies the regex one '
                              'line at a time.')
-    parser.add_argument('-d', action='store', type=str, default='.',
+    parser.add_argument('-d', action='append', type=str,
                         help='The path whose descendent files '
                              'are to be explored. '
-                             'Defaults to current dir.')
+                             'Defaults to current dir.  Give it more than '
+                             'once to explore several directories in one '
+                             'session.')
     parser.add_argument('-i', action='store_true',
                         help='Perform case-insensitive search.')
+    parser.add_argument('--bytes', action='store_true',
+                        help='Match the regex against the raw bytes of each '
+                             'file, without decoding it, and write changes '
+                             'back byte for byte.')
 
     parser.add_argument('--start', action='store', type=str,
                         help='A path:line_number-formatted position somewhere'
@@ -419,6 +1221,11 @@ def _parse_command_line():
                              'which we should stop exploring, '
                              'or a percentage of the way through, '
                              'just before which to end.')
+    parser.add_argument('--work-queue', action='store', type=str,
+                        help='A directory shared by everyone running this '
+                             'same codemod.  Each session claims one file '
+                             'at a time from it, instead of dividing the '
+                             'work up with --start and --end.')
 
     parser.add_argument('--extensions', action='store',
                         default='*', type=str,
@@ -432,6 +1239,25 @@ def _parse_command_line():
     parser.add_argument('--exclude-paths', action='store', type=str,
                         help='A comma-delimited list of paths to exclude.')
 
+    parser.add_argument('--index', action='store_true',
+                        help='Keep a trigram index of the files under the '
+                             'root directory (in .codemod.index there), '
+                             'and only read the files that can match.')
+
+    parser.add_argument('--stream-threshold', action='store', type=int,
+                        help='Never read files bigger than this many bytes '
+                             'into memory; scan and rewrite them a piece '
+                             'at a time instead (single-line mode only).')
+    parser.add_argument('--dedup', action='store_true',
+                        help='Search each distinct file contents once, and '
+                             'suggest the same changes in every copy.')
+    parser.add_argument('--follow-symlinks', action='store_true',
+                        help='Also explore symlinked directories (each '
+                             'directory only once).')
+    parser.add_argument('--respect-gitignore', action='store_true',
+                        help='Skip files and directories ignored by '
+                             '.gitignore and .ignore files.')
+
     parser.add_argument('--accept-all', action='store_true',
                         help='Automatically accept all '
                              'changes (use with caution).')
@@ -440,14 +1266,46 @@ def _parse_command_line():
                         help='If set, this will make the default '
                              'option to not accept the change.')
 
+    parser.add_argument('--group', action='store_true',
+                        help='Find every match first, then ask about each '
+                             'distinct change once and apply it everywhere '
+                             'it occurs.')
+
+    parser.add_argument('--batch-edit', action='store_true',
+                        help='Rather than opening the editor for each '
+                             'change you choose to edit, open it once at '
+                             'the end on a quickfix list of all of them.')
+
+    parser.add_argument('--decision-log', action='store', type=str,
+                        help='A file in which to remember the changes you '
+                             'reject, so that running codemod again '
+                             'doesn\'t ask about them again.')
+
+    parser.add_argument('--validate', action='store', type=str,
+                        help='Check every file codemod changed once it\'s '
+                             'done: "py_compile", or a shell command such '
+                             'as "php -l" ({} is replaced by the path, '
+                             'which is otherwise added at the end).')
+    parser.add_argument('--jobs', action='store', type=int,
+                        help='How many files to validate at once. '
+                             'Defaults to the number of CPUs.')
+
     parser.add_argument('--editor', action='store', type=str,
                         help='Specify an editor, e.g. "vim" or emacs". '
                         'If omitted, defaults to $EDITOR environment '
                         'variable.')
+    parser.add_argument('--no-progress', action='store_true',
+                        help='Don\'t show how far through the search codemod '
+                             'is.  (It\'s never shown if the output isn\'t '
+                             'a terminal.)')
     parser.add_argument('--count', action='store_true',
                         help='Don\'t run normally.  Instead, just print '
                              'out number of times places in the codebase '
                              'where the \'query\' matches.')
+    parser.add_argument('--cache-size', action='store', type=int,
+                        help='Remember the result of the single-line regex '
+                             'for up to this many distinct lines. Speeds '
+                             'up trees with many repeated lines.')
     parser.add_argument('match', nargs='?', action='store', type=str,
                         help='Regular expression to match.')
     parser.add_argument('subst', nargs='?', action='store', type=str,
@@ -456,18 +1314,45 @@ def _parse_command_line():
     arguments = parser.parse_args()
     if not arguments.match:
         parser.exit(0, parser.format_usage())
+    if arguments.work_queue is not None:
+        for option in ('group', 'dedup'):
+            if getattr(arguments, option):
+                parser.error('--%s can\'t be used with --work-queue' % option)
 
     query_options = {}
     yes_to_all = arguments.accept_all
 
-    query_options['suggestor'] = (
-        multiline_regex_suggestor if arguments.m else regex_suggestor
-    )(arguments.match, arguments.subst, arguments.i)
+    match, subst = arguments.match, arguments.subst
+    if arguments.bytes:
+        match = _command_line_bytes(match)
+        if subst is not None:
+            subst = _command_line_bytes(subst)
+    if arguments.m:
+        query_options['suggestor'] = multiline_regex_suggestor(
+            match, subst, arguments.i
+        )
+    else:
+        query_options['suggestor'] = regex_suggestor(
+            match, subst, arguments.i,
+            cache_size=arguments.cache_size
+        )
+    query_options['binary'] = arguments.bytes
 
     query_options['start'] = arguments.start
     query_options['end'] = arguments.end
-    query_options['root_directory'] = arguments.d
+    query_options['root_directory'] = arguments.d or '.'
     query_options['inc_extensionless'] = arguments.include_extensionless
+    query_options['use_index'] = arguments.index
+    query_options['stream_threshold'] = arguments.stream_threshold
+    query_options['dedup_content'] = arguments.dedup
+    query_options['follow_symlinks'] = arguments.follow_symlinks
+    query_options['respect_ignore_files'] = arguments.respect_gitignore
+    if not arguments.no_progress:
+        from codemod.progress import terminal_progress_printer
+        query_options['progress'] = terminal_progress_printer()
+    if arguments.work_queue is not None:
+        from codemod.workqueue import WorkQueue
+        query_options['work_queue'] = WorkQueue(arguments.work_queue)
 
     if arguments.exclude_paths is not None:
         exclude_paths = arguments.exclude_paths.split(',')
@@ -484,13 +1369,37 @@ def _parse_command_line():
         options['editor'] = arguments.editor
     options['just_count'] = arguments.count
     options['default_no'] = arguments.default_no
+    options['group_identical'] = arguments.group
+    options['batch_edit'] = arguments.batch_edit
+    options['decision_log'] = arguments.decision_log
+    if arguments.validate is not None:
+        import codemod.validate as validate
+        options['validator'] = validate.get_validator(arguments.validate)
+    options['validation_jobs'] = arguments.jobs
 
     return options
 
 
+def _command_line_bytes(argument):
+    """Returns a command line argument as the bytes that were typed."""
+    if isinstance(argument, bytes):
+        return argument
+    return os.fsencode(argument)
+
+
 def main():
     options = _parse_command_line()
-    run_interactive(**options)
+    failures = run_interactive(**options)
+    line_transformation = getattr(
+        options['query'].suggestor, 'line_transformation', None
+    )
+    if isinstance(line_transformation, helpers.MemoizedLineTransformation):
+        print('Line cache: %s' % line_transformation.cache_info())
+    query = options['query']
+    if query.linked_files or query.duplicate_files:
+        print('Deduplication: %s' % query.dedup_info())
+    if failures:
+        sys.exit(1)
 
 
 if __name__ == '__main__':
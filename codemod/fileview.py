@@ -0,0 +1,230 @@
+"""
+A file's contents as both text and lines, for suggestors that want to search
+the whole file at once without joining and splitting it themselves.
+"""
+import bisect
+import functools
+
+
+class FileView(object):
+    r"""
+    The contents of a file, given as its text or as its lines.  Whichever
+    wasn't given is worked out the first time it's asked for, as is the
+    table of where each line starts.  The text can be bytes, in which case
+    so are the lines.
+
+    >>> view = FileView('ab\nc\nd')
+    >>> view.line_offsets
+    [0, 3, 5]
+    >>> view.offset_to_position(4), view.position_to_offset(1, 1)
+    ((1, 1), 4)
+    >>> view.line(1), len(view)
+    ('c\n', 3)
+    >>> view.lines
+    ['ab\n', 'c\n', 'd']
+    >>> FileView(lines=['x\n', 'y']).text
+    'x\ny'
+    >>> len(FileView('')), len(FileView('a\n'))
+    (0, 1)
+    >>> FileView(b'a\r\nb').lines == [b'a\r\n', b'b']
+    True
+    """
+
+    def __init__(self, text=None, lines=None, binary=None):
+        """
+        @param binary  Whether the contents are bytes.  Only needed if they
+                       are given as an empty list of lines.
+        """
+        if binary is None:
+            binary = isinstance(
+                text if lines is None else (lines or [''])[0], bytes)
+        self.newline = b'\n' if binary else '\n'
+        self._text = text
+        self._lines = lines
+        self._line_offsets = None
+        # Lines we split ourselves each end in their only newline.
+        self._split_from_text = lines is None
+
+    @property
+    def text(self):
+        if self._text is None:
+            self._text = self.newline[:0].join(self._lines)
+        return self._text
+
+    @property
+    def lines(self):
+        """
+        The lines, each with its newline.  This list is the one update()
+        changes, so it can be handed to list-based code that expects its
+        lines to be updated in place.
+        """
+        if self._lines is None:
+            self._lines = _split_lines(self._text)
+        return self._lines
+
+    @property
+    def line_offsets(self):
+        """The offset into text at which each line starts."""
+        if self._line_offsets is None:
+            if self._lines is not None:
+                self._line_offsets = _line_offsets(self._lines)
+            else:
+                self._line_offsets = _text_line_offsets(self._text)
+        return self._line_offsets
+
+    @property
+    def newline_terminated(self):
+        r"""
+        True if every line but the last ends in its only newline, so that
+        offsets into text map onto lines the same way a search of each line
+        would.
+
+        >>> FileView(lines=['a', 'b\n']).newline_terminated
+        False
+        """
+        if self._split_from_text:
+            return True
+        lines = self.lines
+        if not lines:
+            return True
+        return self.text.count(self.newline) == (
+            len(lines) - (not lines[-1].endswith(self.newline)))
+
+    def __len__(self):
+        if self._line_offsets is None and self._lines is None:
+            text = self._text
+            return text.count(self.newline) + (
+                bool(text) and not text.endswith(self.newline))
+        return len(self.line_offsets)
+
+    def line(self, line_number):
+        """Returns one line, without splitting the whole text."""
+        if self._lines is not None:
+            return self._lines[line_number]
+        offsets = self.line_offsets
+        if line_number + 1 < len(offsets):
+            return self._text[offsets[line_number]:offsets[line_number + 1]]
+        return self._text[offsets[line_number]:]
+
+    def offset_to_position(self, offset):
+        """
+        Returns the (line number, column) of an offset into text.  The end of
+        the text is a position too.
+        """
+        text = self.text
+        if not 0 <= offset <= len(text):
+            raise IndexError('offset %d out of range' % offset)
+        if self._line_offsets is None and self._split_from_text:
+            # Cheaper than building the table for a few lookups.
+            newline = self.newline
+            line_start = text.rfind(newline, 0, offset) + 1
+            if line_start == len(text) and line_start:
+                line_start = text.rfind(newline, 0, offset - 1) + 1
+            return text.count(newline, 0, line_start), offset - line_start
+        line_number = max(
+            0, bisect.bisect_right(self.line_offsets, offset) - 1)
+        return line_number, offset - (
+            self.line_offsets[line_number] if self.line_offsets else 0)
+
+    def position_to_offset(self, line_number, column):
+        """Returns the offset into text of a (line number, column)."""
+        return self.line_offsets[line_number] + column
+
+    def update(self, contents):
+        """
+        Replaces the contents with `contents` (a list of lines or another
+        FileView), e.g. after a patch was applied, keeping the same list of
+        lines.
+        """
+        if isinstance(contents, FileView):
+            text, lines = contents._text, contents._lines
+        else:
+            text, lines = None, contents
+        if self._lines is not None:
+            self._lines[:] = _split_lines(text) if lines is None else lines
+        elif lines is not None:
+            self._lines = list(lines)
+        self._text = text
+        self._line_offsets = None
+        self._split_from_text = lines is None
+
+
+def file_view_suggestor(suggestor):
+    r"""
+    Marks `suggestor` as taking a FileView rather than a list of lines, so
+    Query hands it one.  The suggestor can still be called with a list: it's
+    wrapped in a FileView that's refreshed after each patch, in case the
+    caller updates the list in place.
+
+    >>> @file_view_suggestor
+    ... def suggestor(view):
+    ...     yield view.offset_to_position(view.text.index('b'))
+    >>> list(suggestor(['a\n', 'ab\n']))
+    [(1, 1)]
+    """
+    @functools.wraps(suggestor)
+    def view_suggestor(lines):
+        if isinstance(lines, FileView):
+            for patch in suggestor(lines):
+                yield patch
+            return
+        view = FileView(lines=lines)
+        for patch in suggestor(view):
+            yield patch
+            view.update(lines)
+    view_suggestor.file_view = True
+    return view_suggestor
+
+
+def _split_lines(text):
+    r"""
+    Splits text into lines the way reading a file does: only at newlines.
+
+    >>> _split_lines('a\n\x0cb\nc')
+    ['a\n', '\x0cb\n', 'c']
+    >>> _split_lines('')
+    []
+    """
+    newline = _newline(text)
+    lines = text.splitlines(True)
+    if len(lines) == text.count(newline) + (
+            bool(text) and not text.endswith(newline)):
+        return lines  # there were no other line boundaries
+    lines = [line + newline for line in text.split(newline)]
+    lines[-1] = lines[-1][:-1]
+    if not lines[-1]:
+        lines.pop()
+    return lines
+
+
+def _line_offsets(lines):
+    r"""
+    >>> _line_offsets(['ab\n', 'c\n', 'd'])
+    [0, 3, 5]
+    """
+    offsets = []
+    offset = 0
+    for line in lines:
+        offsets.append(offset)
+        offset += len(line)
+    return offsets
+
+
+def _text_line_offsets(text):
+    r"""
+    >>> _text_line_offsets('ab\nc\nd'), _text_line_offsets('a\n')
+    ([0, 3, 5], [0])
+    """
+    if not text:
+        return []
+    offsets = [0]
+    newline = _newline(text)
+    offset = text.find(newline)
+    while offset != -1 and offset + 1 < len(text):
+        offsets.append(offset + 1)
+        offset = text.find(newline, offset + 1)
+    return offsets
+
+
+def _newline(text):
+    return b'\n' if isinstance(text, bytes) else '\n'
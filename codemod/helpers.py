@@ -1,5 +1,6 @@
 import fnmatch
 import os
+from collections import OrderedDict
 
 
 def is_extensionless(path):
@@ -90,3 +91,61 @@ def path_filter(extensions, exclude_paths=None):
                     return False
         return True
     return the_filter
+
+
+class MemoizedLineTransformation(object):
+    """
+    Wraps a line transformation with a bounded LRU cache keyed by line
+    content.  Only wrap transformations whose output depends on nothing but
+    the line itself.
+
+    >>> upper = MemoizedLineTransformation(lambda line: line.upper(), 2)
+    >>> [upper(line) for line in ['a', 'b', 'a', 'c', 'b']]
+    ['A', 'B', 'A', 'C', 'B']
+    >>> upper.hits, upper.misses
+    (1, 4)
+    >>> len(upper)
+    2
+    """
+    _missing = object()
+
+    def __init__(self, line_transformation, max_size=4096):
+        """
+        @param line_transformation  The function to memoize.
+        @param max_size             The maximum number of distinct lines
+                                    to remember.  The least recently used
+                                    line is evicted first.
+        """
+        if max_size < 1:
+            raise ValueError('max_size must be at least 1')
+        self.line_transformation = line_transformation
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._cache = OrderedDict()
+
+    def __call__(self, line):
+        result = self._cache.pop(line, self._missing)
+        if result is self._missing:
+            self.misses += 1
+            result = self.line_transformation(line)
+            if len(self._cache) >= self.max_size:
+                self._cache.popitem(last=False)
+        else:
+            self.hits += 1
+        self._cache[line] = result
+        return result
+
+    def __len__(self):
+        return len(self._cache)
+
+    def cache_info(self):
+        """
+        Returns a human-readable summary of the cache's effectiveness.
+
+        >>> MemoizedLineTransformation(len, 8).cache_info()
+        'hits=0 misses=0 size=0/8'
+        """
+        return 'hits=%d misses=%d size=%d/%d' % (
+            self.hits, self.misses, len(self._cache), self.max_size
+        )
@@ -0,0 +1,194 @@
+"""
+.gitignore-style rules, so the walk can skip ignored files and never go into
+ignored directories.
+"""
+import os
+import re
+
+# Read in this order, so rules in .ignore win over those in .gitignore.
+RULE_FILE_NAMES = ('.gitignore', '.ignore')
+
+# directory -> (signatures of its rule files, its IgnoreRules), so each
+# directory's rules are only compiled again if its rule files change.
+_rules_cache = {}
+
+
+class IgnoreRules(object):
+    r"""
+    The rules from the rule files in one directory.  Patterns follow
+    .gitignore: '!' re-includes, a trailing '/' only matches directories, a
+    pattern with a '/' elsewhere is relative to the directory, and '**'
+    matches any number of directories.
+
+    >>> rules = IgnoreRules.parse('/src', [
+    ...     '# build output\n', 'dist/\n', '*.min.js\n', '!keep.min.js\n',
+    ...     '/TODO\n', 'docs/**/*.html\n'])
+    >>> rules.match('/src/a/dist', True), rules.match('/src/a/dist', False)
+    (True, None)
+    >>> rules.match('/src/x.min.js', False)
+    True
+    >>> rules.match('/src/keep.min.js', False)
+    False
+    >>> rules.match('/src/TODO', False), rules.match('/src/a/TODO', False)
+    (True, None)
+    >>> rules.match('/src/docs/a/b/c.html', False)
+    True
+    """
+
+    def __init__(self, directory, rules):
+        self.directory = directory
+        self._prefix = os.path.join(directory, '')
+        self._rules = rules  # (regex, negated, directories_only)
+
+    @classmethod
+    def parse(cls, directory, lines):
+        rules = []
+        for line in lines:
+            line = line.rstrip('\n').rstrip('\r')
+            if not line.endswith('\\ '):
+                line = line.rstrip(' ')
+            if not line or line.startswith('#'):
+                continue
+            negated = line.startswith('!')
+            if negated:
+                line = line[1:]
+            elif line.startswith('\\'):
+                line = line[1:]  # e.g. \# or \!
+            directories_only = line.endswith('/')
+            line = line.rstrip('/')
+            if not line:
+                continue
+            anchored = '/' in line
+            line = line.lstrip('/')
+            regex = _translate(line)
+            if not anchored:
+                regex = '(?:.*/)?' + regex
+            rules.append(
+                (re.compile('^%s$' % regex, re.DOTALL), negated,
+                 directories_only))
+        return cls(directory, rules)
+
+    def match(self, path, is_directory):
+        """
+        Returns True if the last rule matching `path` (which must be under
+        self.directory) ignores it, False if it re-includes it, or None if no
+        rule matches.
+        """
+        if not self._rules or not path.startswith(self._prefix):
+            return None
+        relative_path = path[len(self._prefix):]
+        if os.sep != '/':
+            relative_path = relative_path.replace(os.sep, '/')
+        for regex, negated, directories_only in reversed(self._rules):
+            if directories_only and not is_directory:
+                continue
+            if regex.match(relative_path):
+                return not negated
+        return None
+
+
+def _translate(pattern):
+    r"""
+    Returns a regex for a glob pattern in which '*' and '?' don't match '/'
+    and '**' does.
+
+    >>> print(_translate('a/**/b*.py'))
+    a/(?:.*/)?b[^/]*\.py
+    """
+    regex = []
+    i, length = 0, len(pattern)
+    while i < length:
+        if pattern.startswith('**/', i):
+            regex.append('(?:.*/)?')
+            i += 3
+        elif pattern.startswith('**', i):
+            regex.append('.*')
+            i += 2
+        elif pattern[i] == '*':
+            regex.append('[^/]*')
+            i += 1
+        elif pattern[i] == '?':
+            regex.append('[^/]')
+            i += 1
+        elif pattern[i] == '[' and ']' in pattern[i + 2:]:
+            end = pattern.index(']', i + 2)
+            members = pattern[i + 1:end].replace('\\', '\\\\')
+            if members.startswith('!'):
+                members = '^' + members[1:]
+            regex.append('[%s]' % members)
+            i = end + 1
+        elif pattern[i] == '/':
+            regex.append('/')  # re.escape escapes it before Python 3.7
+            i += 1
+        elif pattern[i] == '\\' and i + 1 < length:
+            regex.append(re.escape(pattern[i + 1]))
+            i += 2
+        else:
+            regex.append(re.escape(pattern[i]))
+            i += 1
+    return ''.join(regex)
+
+
+def load_rules(directory):
+    """
+    Returns the IgnoreRules in the rule files in `directory`, or None if
+    there are none.
+    """
+    signatures = []
+    for name in RULE_FILE_NAMES:
+        try:
+            stat = os.stat(os.path.join(directory, name))
+        except OSError:
+            continue
+        signatures.append((name, stat.st_mtime, stat.st_size))
+    if not signatures:
+        return None
+    cached = _rules_cache.get(directory)
+    if cached is not None and cached[0] == signatures:
+        return cached[1]
+    lines = []
+    for name, _, _ in signatures:
+        try:
+            with open(os.path.join(directory, name)) as rule_file:
+                lines.extend(rule_file)
+        except (IOError, UnicodeDecodeError):
+            pass
+    rules = IgnoreRules.parse(directory, lines) if lines else None
+    _rules_cache[directory] = (signatures, rules)
+    return rules
+
+
+def inherited_rules(directory):
+    """
+    Returns the rules that apply to `directory` from the directories above
+    it, up to the top of the git checkout it's in (if it's in one), outermost
+    first.
+    """
+    directory = os.path.abspath(directory)
+    if os.path.exists(os.path.join(directory, '.git')):
+        return []  # the top of the checkout
+    ancestors = []
+    parent = os.path.dirname(directory)
+    while parent != directory:
+        directory = parent
+        ancestors.append(directory)
+        if os.path.exists(os.path.join(directory, '.git')):
+            break
+        parent = os.path.dirname(directory)
+    else:
+        return []  # not in a git checkout
+    rule_sets = (load_rules(ancestor) for ancestor in reversed(ancestors))
+    return [rules for rules in rule_sets if rules is not None]
+
+
+def is_ignored(rule_sets, path, is_directory):
+    """
+    Returns True if `path` is ignored by `rule_sets` (outermost first), where
+    rules in inner directories override those in outer ones.
+    """
+    ignored = False
+    for rules in rule_sets:
+        result = rules.match(path, is_directory)
+        if result is not None:
+            ignored = result
+    return ignored
@@ -0,0 +1,439 @@
+"""
+A trigram index of the files under a directory, used to skip the files that
+can't match a regex without reading them.
+"""
+import array
+import bisect
+import os
+import re
+import struct
+import sys
+
+try:
+    import re._parser as sre_parse
+except ImportError:
+    import sre_parse
+
+INDEX_FILE_NAME = '.codemod.index'
+
+# The index is inverted: for each trigram, the ids of the files containing
+# it, so a query only reads the lists for the trigrams it needs.  It's a
+# plain binary format rather than a pickle, so that loading an index
+# someone else wrote can't run code:
+#
+#   _INDEX_MAGIC
+#   _HEADER: file count, trigram count, size of the file table in bytes
+#   the file table: for each file id, a _FILE_ENTRY (path length, mtime,
+#     size) and the path; an empty path is an id no longer in use
+#   the trigrams, sorted, as unsigned 32-bit ints
+#   for each trigram, where its list starts (in ids), plus where the last
+#     one ends
+#   the lists of file ids
+#
+# All numbers are little-endian.
+_INDEX_MAGIC = b'codemod trigram index 2\n'
+_HEADER = struct.Struct('<III')
+_FILE_ENTRY = struct.Struct('<IdQ')
+_UINT32 = 'I' if array.array('I').itemsize == 4 else 'L'
+
+# Characters that don't take part in trigrams: newlines, since the index is
+# built from raw bytes but text-mode reads translate '\r\n', and (under
+# IGNORECASE) letters that also match non-ASCII characters such as the Kelvin
+# sign.
+_NEWLINES = frozenset(map(ord, '\r\n'))
+_CASE_FOLDING = frozenset(map(ord, 'KkSsIi'))
+
+
+def trigrams(data):
+    """
+    Returns the set of (lowercased) byte trigrams of `data`, each packed into
+    an int.
+
+    >>> sorted(trigrams(b'Abcd')) == [0x616263, 0x626364]
+    True
+    """
+    data = bytearray(data.lower())
+    return set(
+        (a << 16) | (b << 8) | c
+        for a, b, c in set(zip(data, data[1:], data[2:]))
+    )
+
+
+def required_trigrams(regex):
+    r"""
+    Returns a set of trigrams that any text matching `regex` must contain.  An
+    empty set means the index can't rule out any file.
+
+    >>> required_trigrams(re.compile(r'ab(c)de+')) == trigrams(b'abcd')
+    True
+    >>> len(required_trigrams(re.compile(r'foo|bar')))
+    0
+    """
+    result = set()
+    try:
+        parsed = sre_parse.parse(regex.pattern, regex.flags)
+    except Exception:
+        return result
+    ignore_case = bool(regex.flags & re.IGNORECASE)
+    for run in _literal_runs(parsed, ignore_case):
+        if len(run) >= 3:
+            result |= trigrams(bytes(bytearray(run)))
+    return result
+
+
+def _literal_runs(parsed, ignore_case):
+    """
+    Returns the runs of ASCII characters that every match of the parsed
+    pattern contains, as lists of code points.
+    """
+    runs = [[]]
+
+    def end_run():
+        if runs[-1]:
+            runs.append([])
+
+    def visit(items, ignore_case):
+        for op, av in items:
+            name = str(op).upper()
+            if name == 'LITERAL':
+                if (av >= 128 or av in _NEWLINES or
+                        (ignore_case and av in _CASE_FOLDING)):
+                    end_run()
+                else:
+                    runs[-1].append(av)
+            elif name == 'SUBPATTERN' and av[-1] is not None:
+                # The group has to match, so its literals are required and
+                # may continue the current run.  (Its av is (group, pattern)
+                # on Python 2 and (group, add_flags, del_flags, pattern) on
+                # Python 3.)
+                visit(av[-1], ignore_case or (
+                    len(av) == 4 and bool(av[1] & re.IGNORECASE)))
+            elif name.endswith('_REPEAT') and av[0] >= 1:
+                end_run()
+                visit(av[2], ignore_case)
+                end_run()
+            else:
+                end_run()
+
+    visit(parsed, ignore_case)
+    return [run for run in runs if run]
+
+
+class TrigramIndex(object):
+    r"""
+    Remembers which files contain each trigram, and each file's size and
+    modification time, so only new or changed files are read again.  Files
+    that change get new ids; the old ids are left in the lists (as unused
+    ids) until there are as many of them as files, and then the lists are
+    rebuilt.
+
+    >>> import shutil, tempfile
+    >>> directory = tempfile.mkdtemp()
+    >>> def write(name, text):
+    ...     with open(os.path.join(directory, name), 'w') as file_w:
+    ...         file_w.write(text)
+    ...     return os.path.join(directory, name)
+    >>> paths = [write('a.py', 'foo()\n'), write('b.py', 'bar()\n')]
+    >>> index = TrigramIndex(directory)
+    >>> [os.path.basename(path) for path in
+    ...  index.candidates(paths, re.compile('foo'))]
+    ['a.py']
+    >>> index = TrigramIndex(directory)  # e.g. in the next run
+    >>> index.update(paths), index.update(paths[:1])
+    (0, 0)
+    >>> paths.append(write('c.py', 'bar(foo)\n'))
+    >>> [os.path.basename(path) for path in
+    ...  TrigramIndex(directory).candidates(paths, re.compile('foo'))]
+    ['a.py', 'c.py']
+    >>> shutil.rmtree(directory)
+    """
+
+    def __init__(self, root_directory='.', index_path=None):
+        """
+        @param root_directory  The directory whose files are indexed.
+        @param index_path      Where to store the index.  Defaults to
+                               .codemod.index in root_directory.
+        """
+        self.root_directory = root_directory
+        self.index_path = index_path or os.path.join(
+            root_directory, INDEX_FILE_NAME)
+        self._paths = None  # file id -> path, or None for an unused id
+        self._ids = {}  # path -> file id
+        self._signatures = {}  # path -> (mtime, size)
+        # The trigrams and where their lists start, as read from the index
+        # file, which is kept open to read the lists as they're needed.
+        self._trigrams = _uint32_array()
+        self._starts = _uint32_array()
+        self._index_file = None
+        self._lists_offset = 0
+        # Every list, once the index has changed: trigram -> file ids.
+        self._lists = None
+        self._changed = False
+
+    def _load(self):
+        self._paths = []
+        try:
+            self._index_file = open(self.index_path, 'rb')
+        except IOError:
+            return
+        try:
+            self._read_tables(self._index_file)
+        except (ValueError, struct.error):
+            # An older or damaged index: start again.
+            self.close()
+            self._paths, self._ids, self._signatures = [], {}, {}
+            self._trigrams, self._starts = _uint32_array(), _uint32_array()
+            self._changed = True
+
+    def _read_tables(self, index_file):
+        if index_file.read(len(_INDEX_MAGIC)) != _INDEX_MAGIC:
+            raise ValueError('not a codemod index')
+        file_count, trigram_count, table_size = _HEADER.unpack(
+            index_file.read(_HEADER.size))
+        table = index_file.read(table_size)
+        offset = 0
+        for file_id in range(file_count):
+            path_length, mtime, size = _FILE_ENTRY.unpack_from(table, offset)
+            offset += _FILE_ENTRY.size
+            path = _decode_path(table[offset:offset + path_length])
+            offset += path_length
+            if not path:
+                self._paths.append(None)
+                continue
+            self._paths.append(path)
+            self._ids[path] = file_id
+            self._signatures[path] = (mtime, size)
+        self._trigrams = _read_uint32s(index_file, trigram_count)
+        self._starts = _read_uint32s(index_file, trigram_count + 1)
+        self._lists_offset = index_file.tell()
+
+    def close(self):
+        if self._index_file is not None:
+            self._index_file.close()
+            self._index_file = None
+
+    def _list(self, trigram):
+        """Returns the ids of the files that contain `trigram`."""
+        if self._lists is not None:
+            return self._lists.get(trigram, ())
+        position = bisect.bisect_left(self._trigrams, trigram)
+        if (position == len(self._trigrams) or
+                self._trigrams[position] != trigram):
+            return ()
+        start, end = self._starts[position], self._starts[position + 1]
+        self._index_file.seek(self._lists_offset + 4 * start)
+        return _read_uint32s(self._index_file, end - start)
+
+    def _load_lists(self):
+        """Reads every list into memory, so they can be changed."""
+        if self._lists is not None:
+            return
+        self._lists = {}
+        if len(self._trigrams):
+            self._index_file.seek(self._lists_offset)
+            ids = _read_uint32s(self._index_file, self._starts[-1])
+            starts = self._starts
+            for position, trigram in enumerate(self._trigrams):
+                self._lists[trigram] = ids[
+                    starts[position]:starts[position + 1]]
+        self.close()
+
+    def save(self):
+        """Writes the index, if it has changed since it was read."""
+        if not self._changed:
+            return
+        import tempfile
+        directory = os.path.dirname(os.path.abspath(self.index_path))
+        file_fd, temporary_path = tempfile.mkstemp(
+            prefix='.codemod-index-', dir=directory)
+        try:
+            with os.fdopen(file_fd, 'wb') as index_file:
+                self._write(index_file)
+            os.rename(temporary_path, self.index_path)
+        except BaseException:
+            os.remove(temporary_path)
+            raise
+        self._changed = False
+
+    def _write(self, index_file):
+        table = []
+        for path in self._paths:
+            encoded_path = _encode_path(path) if path is not None else b''
+            mtime, size = self._signatures.get(path, (0, 0))
+            table.append(_FILE_ENTRY.pack(len(encoded_path), mtime, size))
+            table.append(encoded_path)
+        table = b''.join(table)
+        trigrams = sorted(self._lists)
+        starts = _uint32_array()
+        ids = _uint32_array()
+        for trigram in trigrams:
+            starts.append(len(ids))
+            ids.extend(self._lists[trigram])
+        starts.append(len(ids))
+        index_file.write(_INDEX_MAGIC)
+        index_file.write(_HEADER.pack(len(self._paths), len(trigrams),
+                                      len(table)))
+        index_file.write(table)
+        index_file.write(_uint32_bytes(_uint32_array(trigrams)))
+        index_file.write(_uint32_bytes(starts))
+        index_file.write(_uint32_bytes(ids))
+
+    def update(self, paths):
+        """
+        Brings the index up to date for the given paths, reading only the
+        files that are new or have changed since they were last indexed.
+        Files not given are kept (so queries over different files share the
+        index), unless they no longer exist.  Returns the number of files
+        read.
+        """
+        if self._paths is None:
+            self._load()
+        paths = set(paths)
+        stale = []
+        fresh = []  # (path, signature)
+        for path in paths:
+            try:
+                stat = os.stat(path)
+            except OSError:
+                if path in self._ids:
+                    stale.append(path)
+                continue
+            signature = (stat.st_mtime, stat.st_size)
+            if self._signatures.get(path) != signature:
+                fresh.append((path, signature))
+                if path in self._ids:
+                    stale.append(path)
+        stale.extend(
+            path for path in self._ids
+            if path not in paths and not os.path.exists(path))
+        if not stale and not fresh:
+            return 0
+
+        self._load_lists()
+        self._changed = True
+        for path in stale:
+            self._paths[self._ids.pop(path)] = None
+            del self._signatures[path]
+        files_read = 0
+        for path, signature in fresh:
+            try:
+                with open(path, 'rb') as file_r:
+                    path_trigrams = trigrams(file_r.read())
+            except IOError:
+                continue
+            files_read += 1
+            file_id = len(self._paths)
+            self._paths.append(path)
+            self._ids[path] = file_id
+            self._signatures[path] = signature
+            for trigram in path_trigrams:
+                ids = self._lists.get(trigram)
+                if ids is None:
+                    ids = self._lists[trigram] = _uint32_array()
+                ids.append(file_id)
+        if len(self._paths) > 2 * len(self._ids):
+            self._compact()
+        return files_read
+
+    def _compact(self):
+        """Renumbers the files, leaving out the ids no longer in use."""
+        new_ids = {}
+        paths = []
+        for file_id, path in enumerate(self._paths):
+            if path is not None:
+                new_ids[file_id] = len(paths)
+                paths.append(path)
+        for trigram, ids in list(self._lists.items()):
+            ids = _uint32_array(
+                new_ids[file_id] for file_id in ids if file_id in new_ids)
+            if ids:
+                self._lists[trigram] = ids
+            else:
+                del self._lists[trigram]
+        self._paths = paths
+        self._ids = dict((path, file_id) for file_id, path in enumerate(paths))
+
+    def candidates(self, paths, regex):
+        """
+        Returns the paths (in order) of the files that might contain a match
+        for `regex`, updating the index first (and saving it, if that
+        changed it).  If the regex has no literal text to look for, that's
+        all of them.
+        """
+        paths = list(paths)
+        required = required_trigrams(regex)
+        if not required:
+            return paths
+        try:
+            self.update(paths)
+            self.save()
+            matching = None
+            for trigram in sorted(required, key=self._list_length):
+                ids = self._list(trigram)
+                matching = set(ids) if matching is None else (
+                    matching.intersection(ids))
+                if not matching:
+                    break
+        finally:
+            self.close()
+        matching_paths = set(self._paths[file_id] for file_id in matching)
+        return [
+            path for path in paths
+            if path not in self._ids or path in matching_paths
+        ]
+
+    def _list_length(self, trigram):
+        if self._lists is not None:
+            return len(self._lists.get(trigram, ()))
+        position = bisect.bisect_left(self._trigrams, trigram)
+        if (position == len(self._trigrams) or
+                self._trigrams[position] != trigram):
+            return 0
+        return self._starts[position + 1] - self._starts[position]
+
+
+def _uint32_array(values=()):
+    return array.array(_UINT32, values)
+
+
+def _read_uint32s(file_r, count):
+    """Reads `count` little-endian unsigned 32-bit ints into an array."""
+    data = file_r.read(4 * count)
+    if len(data) != 4 * count:
+        raise ValueError('truncated index')
+    values = _uint32_array()
+    if hasattr(values, 'frombytes'):
+        values.frombytes(data)
+    else:
+        values.fromstring(data)  # Python 2
+    if sys.byteorder == 'big':
+        values.byteswap()
+    return values
+
+
+def _uint32_bytes(values):
+    r"""
+    >>> _uint32_bytes(_uint32_array([1, 0x10203])) == (
+    ...     b'\x01\x00\x00\x00\x03\x02\x01\x00')
+    True
+    """
+    if sys.byteorder == 'big':
+        values = _uint32_array(values)
+        values.byteswap()
+    if hasattr(values, 'tobytes'):
+        return values.tobytes()
+    return values.tostring()  # Python 2
+
+
+def _encode_path(path):
+    if isinstance(path, bytes):
+        return path
+    if str is bytes:
+        return path.encode('utf-8')  # Python 2 has no surrogateescape
+    return path.encode('utf-8', 'surrogateescape')
+
+
+def _decode_path(encoded_path):
+    if str is bytes:
+        return encoded_path  # Python 2: paths are bytes
+    return encoded_path.decode('utf-8', 'surrogateescape')
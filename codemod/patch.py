@@ -20,7 +20,7 @@ class Patch(object):
     """
 
     def __init__(self, start_line_number, end_line_number=None, new_lines=None,
-                 path=None):  # noqa
+                 path=None, old_lines=None):  # noqa
         """
         Constructs a Patch object.
 
@@ -41,15 +41,19 @@ class Patch(object):
                                 don't have to set the
                                 path explicitly.
                                 (It'll get set by the suggestor's caller.)
+        @param old_lines        The lines in the range, as they were when the
+                                patch was suggested.  Also set by the
+                                suggestor's caller.
         """
         self.path = path
         self.start_line_number = start_line_number
         self.end_line_number = end_line_number
         self.new_lines = new_lines
+        self.old_lines = old_lines
 
         if self.end_line_number is None:
             self.end_line_number = self.start_line_number + 1
-        if isinstance(self.new_lines, str):
+        if isinstance(self.new_lines, (str, bytes)):
             self.new_lines = self.new_lines.splitlines(True)
 
     def __repr__(self):
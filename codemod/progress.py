@@ -0,0 +1,102 @@
+"""
+Progress reporting for long scans.
+"""
+from __future__ import division
+
+import sys
+import time
+
+
+class ScanProgress(object):
+    """
+    How far a Query's scan has got, as passed to its progress callback.
+
+    >>> clock = [2.0, 0.0].pop  # started at 0s, rendered at 2s
+    >>> progress = ScanProgress(4, 4 * 1024 * 1024, clock=clock)
+    >>> progress.files_scanned, progress.bytes_scanned = 1, 1024 * 1024
+    >>> progress.matches = 3
+    >>> print(progress.render())
+    1/4 files, 1.0/4.0 MB, 3 matches, 0.5 MB/s, ETA 0:06
+    """
+
+    def __init__(self, files_total, bytes_total, clock=time.time):
+        self.files_total = files_total
+        self.bytes_total = bytes_total
+        self.files_scanned = 0
+        self.bytes_scanned = 0
+        self.matches = 0
+        self.done = False
+        self._clock = clock
+        self.started = clock()
+
+    def elapsed(self):
+        return self._clock() - self.started
+
+    def rate(self):
+        """Bytes scanned per second so far."""
+        elapsed = self.elapsed()
+        return self.bytes_scanned / elapsed if elapsed > 0 else 0.0
+
+    def eta(self):
+        """Seconds until the scan is done, or None if we can't tell yet."""
+        return self._eta(self.rate())
+
+    def _eta(self, rate):
+        if not rate:
+            return None
+        return (self.bytes_total - self.bytes_scanned) / rate
+
+    def render(self):
+        megabyte = 1024 * 1024
+        rate = self.rate()
+        eta = self._eta(rate)
+        return '%d/%d files, %.1f/%.1f MB, %d matches, %.1f MB/s, ETA %s' % (
+            self.files_scanned, self.files_total,
+            self.bytes_scanned / megabyte, self.bytes_total / megabyte,
+            self.matches, rate / megabyte,
+            '?' if eta is None else '%d:%02d' % divmod(int(eta), 60)
+        )
+
+
+def terminal_progress_printer(interval=0.2, stream=None):
+    r"""
+    Returns a progress callback that keeps a one-line status up to date on
+    `stream` (stdout by default), at most every `interval` seconds, and
+    clears it when the scan is done, or None if the stream isn't a terminal.
+
+    >>> class Terminal(list):
+    ...     write = list.append
+    ...     def flush(self):
+    ...         pass
+    ...     def isatty(self):
+    ...         return True
+    >>> stream = Terminal()
+    >>> print_progress = terminal_progress_printer(stream=stream)
+    >>> progress = ScanProgress(1, 0)
+    >>> print_progress(progress)
+    >>> progress.files_scanned, progress.done = 1, True
+    >>> print_progress(progress)
+    >>> stream == ['\r0/1 files, 0.0/0.0 MB, 0 matches, 0.0 MB/s, ETA ?\033[K',
+    ...            '\r\033[K']
+    True
+    """
+    if stream is None:
+        stream = sys.stdout
+    if not stream.isatty():
+        return None
+    last_printed = [0.0]
+
+    def print_progress(progress):
+        if progress.done:
+            if last_printed[0]:
+                stream.write('\r\033[K')
+                stream.flush()
+            return
+        now = time.time()
+        if now - last_printed[0] < interval:
+            return
+        last_printed[0] = now
+        stream.write('\r%s\033[K' % progress.render())
+        stream.flush()
+
+    return print_progress
@@ -1,7 +1,11 @@
+import itertools
 import os
 import sys
 
+from codemod.fileview import FileView
+from codemod.patch import Patch
 from codemod.position import Position
+from codemod.progress import ScanProgress
 import codemod.helpers as helpers
 
 
@@ -21,12 +25,28 @@ class Query(object):
                  path_filter=helpers.path_filter(
                      extensions=['php', 'phpt', 'js', 'css', 'rb', 'erb']
                  ),
-                 inc_extensionless=False):
+                 inc_extensionless=False,
+                 use_index=False,
+                 stream_threshold=None,
+                 work_queue=None,
+                 progress=None,
+                 writer=None,
+                 dedup_content=False,
+                 follow_symlinks=False,
+                 binary=False,
+                 respect_ignore_files=False):
 
         """
         @param suggestor            A function that takes a list of lines and
                                     generates instances of Patch to suggest.
-                                    (Patches should not specify paths.)
+                                    (Patches should not specify paths.)  If
+                                    it has a true `file_view` attribute (see
+                                    fileview.file_view_suggestor), it's
+                                    given a fileview.FileView instead.  If
+                                    it has a `prepare` attribute, that is
+                                    called with the list of paths to explore
+                                    before any are read (e.g. to parse them
+                                    in parallel).
         @param start                One of:
                                     - an instance of Position
                                     (indicating the place in the file
@@ -45,21 +65,93 @@ class Query(object):
                                     used for start (where None  means
                                     'traverse to the end of the hierarchy).
         @param root_directory       The path whose ancestor files
-                                    are to be explored.
+                                    are to be explored, or a list of
+                                    them, which are walked (and indexed)
+                                    at the same time and explored one
+                                    after another, in the order given.
         @param path_filter          Given a path, returns True or False.
                                     If False,
                                     the entire file is ignored.
         @param inc_extensionless    If True, will include all files without an
                                     extension when checking
                                     against the path_filter
+        @param use_index            If True, and the suggestor has a `regex`
+                                    attribute (as the regex suggestors do),
+                                    keep a trigram index of root_directory
+                                    and only read the files that might match.
+        @param stream_threshold     If given, and the suggestor has a
+                                    `stream` attribute (as the single-line
+                                    suggestors do), files bigger than this
+                                    many bytes are fed to suggestor.stream a
+                                    chunk at a time instead of being read
+                                    into memory.
+        @param work_queue           An instance of workqueue.WorkQueue shared
+                                    with other people running the same
+                                    query.  If given, only the files this
+                                    session manages to claim are explored.
+        @param progress             A function to call with an instance of
+                                    progress.ScanProgress after each file is
+                                    scanned and each patch is found, and
+                                    once more (with its done set) when the
+                                    scan finishes.
+        @param writer               An instance of writer.WriteBehind that
+                                    saves the patches you accept.  If given,
+                                    files are read through it, so the scan
+                                    sees changes it hasn't written yet.
+        @param dedup_content        If True, the suggestor is run once per
+                                    distinct file contents, without seeing
+                                    the changes you accept (as with
+                                    get_all_patches), and its patches are
+                                    reused for every file with the same
+                                    contents.  Patches whose lines have
+                                    changed by the time they come up are
+                                    skipped.  (Hard links and symlinks to a
+                                    file already explored are always
+                                    skipped.)  Can't be used with a
+                                    work_queue.
+        @param follow_symlinks      If True, explore symlinked directories,
+                                    skipping any already explored (which
+                                    also breaks symlink loops).
+        @param binary               If True, files are read as bytes (and
+                                    never decoded), so the suggestor is
+                                    given, and should suggest, bytes.
+        @param respect_ignore_files If True, skip the files and directories
+                                    that .gitignore and .ignore files (in
+                                    root_directory, below it, and above it
+                                    up to the top of its git checkout)
+                                    ignore, without going into ignored
+                                    directories at all.
         """
+        if dedup_content and work_queue is not None:
+            raise ValueError(
+                'dedup_content reuses patches across files, but a work '
+                'queue hands out each file to one session')
         self.suggestor = suggestor
         self._start = start
         self._end = end
         self.root_directory = root_directory
+        if isinstance(root_directory, (list, tuple)):
+            self.root_directories = list(root_directory)
+        else:
+            self.root_directories = [root_directory]
         self.path_filter = path_filter
         self.inc_extensionless = inc_extensionless
+        self.use_index = use_index
+        self.stream_threshold = stream_threshold
+        self.work_queue = work_queue
+        self.progress = progress
+        self.writer = writer
+        self.dedup_content = dedup_content
+        self.follow_symlinks = follow_symlinks
+        self.binary = binary
+        self.respect_ignore_files = respect_ignore_files
         self._all_patches_cache = None
+        # content digest -> the patches the suggestor made for it
+        self._patches_by_content = {}
+        # How much work deduplication saved, for dedup_info.
+        self.linked_files = 0
+        self.duplicate_files = 0
+        self.duplicate_bytes = 0
 
     def clone(self):
         import copy
@@ -108,6 +200,7 @@ class Query(object):
 
         endless_query = self.clone()
         endless_query.start_position = endless_query.end_position = None
+        endless_query.work_queue = None
         self._all_patches_cache = list(endless_query.generate_patches())
         return self._all_patches_cache
 
@@ -134,7 +227,13 @@ class Query(object):
         start_pos = self.start_position or Position(None, None)
         end_pos = self.end_position or Position(None, None)
 
-        path_list = Query._walk_directory(self.root_directory)
+        root_of = {}  # path -> the root directory it was found in
+        path_list = []
+        for root, paths in zip(self.root_directories, _map_concurrently(
+                self._walk_root, self.root_directories)):
+            for path in paths:
+                root_of.setdefault(path, root)
+            path_list.extend(paths)
         path_list = Query._sublist(path_list, start_pos.path, end_pos.path)
         path_list = (
             path for path in path_list if
@@ -142,40 +241,404 @@ class Query(object):
             (self.path_filter(path)) or
             (self.inc_extensionless and helpers.is_extensionless(path))
         )
+        path_list = self._skip_linked_files(path_list)
+        regex = getattr(self.suggestor, 'regex', None)
+        if self.use_index and regex is not None:
+            path_list = self._index_candidates(path_list, root_of, regex)
+        prepare = getattr(self.suggestor, 'prepare', None)
+        if prepare is not None:
+            path_list = list(path_list)
+            prepare(path_list)
+        if self.progress is None:
+            for path in path_list:
+                for patch in self._explore_path(path, start_pos, end_pos):
+                    yield patch
+            return
+
+        path_list = list(path_list)
+        sizes = []
         for path in path_list:
             try:
-                lines = list(open(path))
-            except (IOError, UnicodeDecodeError):
-                # If we can't open the file--perhaps it's a symlink whose
-                # destination no loner exists--then short-circuit.
+                sizes.append(os.path.getsize(path))
+            except OSError:
+                sizes.append(0)
+        progress = ScanProgress(len(path_list), sum(sizes))
+        self.progress(progress)
+        for path, size in zip(path_list, sizes):
+            for patch in self._explore_path(path, start_pos, end_pos):
+                progress.matches += 1
+                self.progress(progress)
+                yield patch
+            progress.files_scanned += 1
+            progress.bytes_scanned += size
+            self.progress(progress)
+        progress.done = True
+        self.progress(progress)
+
+    def _explore_path(self, path, start_pos, end_pos):
+        """
+        Generates the patches for one file, if the work queue (if any) lets
+        this session have it.
+        """
+        if self.work_queue is None:
+            for patch in self._generate_patches_for_path(
+                    path, start_pos, end_pos):
+                yield patch
+            return
+
+        key = self._work_queue_key(path)
+        if not self.work_queue.claim(key):
+            return  # someone else has (or had) this file
+        finished = False
+        try:
+            for patch in self._generate_patches_for_path(
+                    path, start_pos, end_pos):
+                yield patch
+                self.work_queue.renew(key)
+            self.work_queue.finish(key)
+            finished = True
+        finally:
+            if not finished:
+                # e.g. the user quit: let someone else have it.
+                self.work_queue.release(key)
+
+    def _walk_root(self, root_directory):
+        return Query._walk_directory(
+            root_directory, self.follow_symlinks, self.respect_ignore_files)
+
+    def _index_candidates(self, paths, root_of, regex):
+        """
+        Returns the paths (in order) that the trigram index of the root each
+        was found in says might match `regex`, updating the roots' indexes
+        at the same time.
+        """
+        from codemod.index import TrigramIndex
+        paths = list(paths)
+        paths_by_root = dict((root, []) for root in self.root_directories)
+        for path in paths:
+            paths_by_root[root_of[path]].append(path)
+        candidates = set(itertools.chain.from_iterable(_map_concurrently(
+            lambda root: TrigramIndex(root).candidates(
+                paths_by_root[root], regex),
+            self.root_directories)))
+        return [path for path in paths if path in candidates]
+
+    def _work_queue_key(self, path):
+        """
+        Names a file the same way for everyone sharing the work queue: by its
+        path relative to the root directory, or with several roots, to the
+        directory they're all in.
+
+        >>> Query(None, root_directory=['/w/www', '/w/api'])._work_queue_key(
+        ...     '/w/api/a.py')
+        'api/a.py'
+        """
+        if len(self.root_directories) == 1:
+            return os.path.relpath(path, self.root_directories[0])
+        common_prefix = os.path.commonprefix([
+            os.path.join(os.path.abspath(root), '')
+            for root in self.root_directories
+        ])
+        return os.path.relpath(
+            os.path.abspath(path), os.path.dirname(common_prefix))
+
+    def rescan(self, paths):
+        """
+        Generates the patches self.suggestor now suggests for just the given
+        paths (e.g. files that were changed by hand), ignoring
+        self.start_position and self.end_position.
+        """
+        for path in paths:
+            for patch in self._generate_patches_for_path(
+                    path, Position(None, None), Position(None, None)):
+                yield patch
+
+    def should_stream(self, path):
+        """
+        Returns True if the file at `path` is too big to read into memory,
+        and the suggestor can be fed it a chunk at a time.
+        """
+        if (self.stream_threshold is None or
+                getattr(self.suggestor, 'stream', None) is None):
+            return False
+        try:
+            return os.path.getsize(path) > self.stream_threshold
+        except OSError:
+            return False
+
+    def _generate_patches_for_path(self, path, start_pos, end_pos):
+        if self.should_stream(path):
+            for patch in self._stream_patches_for_path(
+                    path, start_pos, end_pos):
+                yield patch
+            return
+
+        try:
+            view = self._read_file(path)
+        except (IOError, UnicodeDecodeError):
+            # If we can't open the file--perhaps it's a symlink whose
+            # destination no loner exists--then short-circuit.
+            return
+
+        if self.dedup_content:
+            for patch in self._reuse_patches_for_path(
+                    path, view, start_pos, end_pos):
+                yield patch
+            return
+
+        for patch in self._suggest(view):
+            if path == start_pos.path:
+                if patch.start_line_number < start_pos.line_number:
+                    continue  # suggestion is pre-start_pos
+            if path == end_pos.path:
+                if patch.end_line_number >= end_pos.line_number:
+                    break  # suggestion is post-end_pos
+
+            old_lines = view.lines[
+                patch.start_line_number:patch.end_line_number]
+            if patch.new_lines is None or patch.new_lines != old_lines:
+                patch.path = path
+                patch.old_lines = old_lines
+                yield patch
+                # re-open file, in case contents changed
+                view.update(self._read_file(path).lines)
+
+    def _suggest(self, view):
+        if getattr(self.suggestor, 'file_view', False):
+            return self.suggestor(view)
+        return self.suggestor(view.lines)
+
+    def _reuse_patches_for_path(self, path, view, start_pos, end_pos):
+        r"""
+        Like _generate_patches_for_path, but with dedup_content: the patches
+        come from the first file seen with the same contents, moved down or
+        up by the lines that patches accepted so far have added or removed.
+
+        >>> import shutil, tempfile
+        >>> path = os.path.join(tempfile.mkdtemp(), 'a.py')
+        >>> def write(text):
+        ...     with open(path, 'w') as file_w:
+        ...         file_w.write(text)
+        >>> def upper_x(lines):
+        ...     for line_number, line in enumerate(lines):
+        ...         if line.startswith('x'):
+        ...             yield Patch(line_number, None, [line.upper()])
+        >>> write('x1\nx2\nx3\n')
+        >>> query = Query(upper_x, dedup_content=True)
+        >>> everywhere = Position(None, None)
+        >>> patches = query._reuse_patches_for_path(
+        ...     path, query._read_file(path), everywhere, everywhere)
+        >>> patch = next(patches)
+        >>> patch.start_line_number, patch.new_lines
+        (0, ['X1\n'])
+
+        Accepting it, along with a line added by hand, moves the rest down:
+
+        >>> write('X1\nnew\nx2\nx3\n')
+        >>> patch = next(patches)
+        >>> patch.start_line_number, patch.new_lines
+        (2, ['X2\n'])
+
+        and a patch whose lines have changed since is skipped:
+
+        >>> write('X1\nnew\nx2\nchanged\n')
+        >>> list(patches)
+        []
+        >>> shutil.rmtree(os.path.dirname(path))
+        """
+        shift = 0
+        for cached in self._patches_for_content(view):
+            patch = Patch(
+                cached.start_line_number + shift,
+                cached.end_line_number + shift,
+                cached.new_lines, path, cached.old_lines
+            )
+            if path == start_pos.path:
+                if patch.start_line_number < start_pos.line_number:
+                    continue  # suggestion is pre-start_pos
+            if path == end_pos.path:
+                if patch.end_line_number >= end_pos.line_number:
+                    break  # suggestion is post-end_pos
+            if view.lines[patch.start_line_number:
+                          patch.end_line_number] != patch.old_lines:
+                continue  # its lines have changed since
+            line_count = len(view)
+            yield patch
+            # re-open file, in case contents changed
+            view.update(self._read_file(path))
+            shift += len(view) - line_count
+
+    def _patches_for_content(self, view):
+        """
+        Returns the patches the suggestor makes for the contents of `view`,
+        with their old_lines, running it only the first time those contents
+        are seen.
+        """
+        import hashlib
+        text = view.text
+        digest = hashlib.sha1(
+            text if isinstance(text, bytes) else text.encode('utf-8')
+        ).hexdigest()
+        if digest in self._patches_by_content:
+            self.duplicate_files += 1
+            self.duplicate_bytes += len(text)
+            return self._patches_by_content[digest]
+
+        scan_view = FileView(text)
+        patches = []
+        for patch in self._suggest(scan_view):
+            old_lines = scan_view.lines[
+                patch.start_line_number:patch.end_line_number]
+            if patch.new_lines is None or patch.new_lines != old_lines:
+                patch.old_lines = old_lines
+                patches.append(patch)
+        self._patches_by_content[digest] = patches
+        return patches
+
+    def dedup_info(self):
+        """Describes how much work deduplication saved."""
+        return ('%d links to files already explored, %d duplicate files '
+                '(%.1f MB) not searched again' % (
+                    self.linked_files, self.duplicate_files,
+                    self.duplicate_bytes / (1024.0 * 1024)))
+
+    def _skip_linked_files(self, paths):
+        """
+        Returns `paths` without any that are hard links or symlinks to a file
+        earlier in the list.  (All of them are looked at up front, as saving
+        a file can give it a new inode.)
+
+        >>> import shutil, tempfile
+        >>> path = os.path.join(tempfile.mkdtemp(), 'a.py')
+        >>> open(path, 'w').close()
+        >>> os.link(path, path + '.hard')
+        >>> os.symlink(path, path + '.soft')
+        >>> query = Query(None)
+        >>> [os.path.basename(unique_path) for unique_path in
+        ...  query._skip_linked_files(
+        ...      [path, path + '.hard', path + '.soft', path + '.missing'])]
+        ['a.py', 'a.py.missing']
+        >>> query.linked_files
+        2
+        >>> shutil.rmtree(os.path.dirname(path))
+        """
+        unique_paths = []
+        seen = set()
+        for path in paths:
+            try:
+                stat = os.stat(path)
+            except OSError:
+                unique_paths.append(path)
+                continue
+            key = (stat.st_dev, stat.st_ino)
+            if stat.st_ino and key in seen:
+                self.linked_files += 1
                 continue
+            seen.add(key)
+            unique_paths.append(path)
+        return unique_paths
 
-            for patch in self.suggestor(lines):
+    def _read_file(self, path):
+        """
+        Returns a FileView of the file at `path`, including any changes the
+        writer hasn't saved yet.
+        """
+        if self.writer is not None:
+            lines = self.writer.pending_lines(path)
+            if lines is not None:
+                return FileView(lines=lines, binary=self.binary)
+        with open(path, 'rb' if self.binary else 'r') as file_r:
+            return FileView(file_r.read())
+
+    def _stream_patches_for_path(self, path, start_pos, end_pos):
+        """
+        Like _generate_patches_for_path, but never holds the whole file in
+        memory.  Patches carry their old_lines, and line numbers refer to the
+        file as it was when the scan started: accepted patches have to be
+        written out in one pass afterwards (see base._stream_save).
+        """
+        try:
+            file_r = open(path, 'rb' if self.binary else 'r')
+        except IOError:
+            return
+        try:
+            for patch in self.suggestor.stream(file_r):
                 if path == start_pos.path:
                     if patch.start_line_number < start_pos.line_number:
                         continue  # suggestion is pre-start_pos
                 if path == end_pos.path:
                     if patch.end_line_number >= end_pos.line_number:
                         break  # suggestion is post-end_pos
-
-                old_lines = lines[
-                    patch.start_line_number:patch.end_line_number]
-                if patch.new_lines is None or patch.new_lines != old_lines:
-                    patch.path = path
-                    yield patch
-                    # re-open file, in case contents changed
-                    lines[:] = list(open(path))
+                patch.path = path
+                yield patch
+        except UnicodeDecodeError:
+            pass
+        finally:
+            file_r.close()
 
     @staticmethod
-    def _walk_directory(root_directory):
+    def _walk_directory(root_directory, follow_symlinks=False,
+                        respect_ignore_files=False):
         """
         Generates the paths of all files that are ancestors
         of `root_directory`.
-        """
 
-        paths = [os.path.join(root, name)
-                 for root, dirs, files in os.walk(root_directory)  # noqa
-                 for name in files]
+        @param follow_symlinks       If True, also explore symlinked
+                                     directories, except ones already
+                                     explored.
+        @param respect_ignore_files  If True, leave out what .gitignore and
+                                     .ignore files ignore, and don't go into
+                                     ignored directories (or .git).
+        """
+        if respect_ignore_files:
+            from codemod import ignore
+            absolute_root = os.path.abspath(root_directory)
+            # directory -> the rules that apply in it, outermost first
+            rule_sets = {root_directory: ignore.inherited_rules(
+                absolute_root)}
+        paths = []
+        seen_directories = set()
+        if follow_symlinks:
+            try:
+                stat = os.stat(root_directory)
+                seen_directories.add((stat.st_dev, stat.st_ino))
+            except OSError:
+                pass
+        for root, dirs, files in os.walk(root_directory,
+                                         followlinks=follow_symlinks):
+            if follow_symlinks:
+                # Prune directories we've been in already (through another
+                # symlink, or a symlink loop).
+                for name in list(dirs):
+                    try:
+                        stat = os.stat(os.path.join(root, name))
+                    except OSError:
+                        dirs.remove(name)
+                        continue
+                    key = (stat.st_dev, stat.st_ino)
+                    if stat.st_ino and key in seen_directories:
+                        dirs.remove(name)
+                    seen_directories.add(key)
+            if respect_ignore_files:
+                relative_root = os.path.relpath(root, root_directory)
+                absolute = os.path.normpath(
+                    os.path.join(absolute_root, relative_root))
+                rules = rule_sets.pop(root)
+                own_rules = ignore.load_rules(absolute)
+                if own_rules is not None:
+                    rules = rules + [own_rules]
+                dirs[:] = [
+                    name for name in dirs if name != '.git' and
+                    not ignore.is_ignored(
+                        rules, os.path.join(absolute, name), True)
+                ]
+                for name in dirs:
+                    rule_sets[os.path.join(root, name)] = rules
+                files = [
+                    name for name in files if not ignore.is_ignored(
+                        rules, os.path.join(absolute, name), False)
+                ]
+            paths.extend(os.path.join(root, name) for name in files)
         paths.sort()
         return paths
 
@@ -213,3 +676,23 @@ class Query(object):
             not path.endswith('tags') and
             not path.endswith('TAGS')
         )
+
+
+def _map_concurrently(function, items):
+    """
+    Returns [function(item) for item in items], calling it for every item
+    at the same time (in threads) if there's more than one.
+
+    >>> _map_concurrently(len, ['a', 'bc', 'def'])
+    [1, 2, 3]
+    """
+    items = list(items)
+    if len(items) < 2:
+        return [function(item) for item in items]
+    from multiprocessing.pool import ThreadPool
+    pool = ThreadPool(len(items))
+    try:
+        return pool.map(function, items)
+    finally:
+        pool.close()
+        pool.join()
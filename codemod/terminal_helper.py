@@ -6,11 +6,9 @@ from __future__ import print_function
 import os
 import sys
 
-import curses
-
-import fcntl
-import termios
-import struct
+# Set up by _curses the first time something is actually drawn, since
+# importing curses and reading the terminal's capabilities take a while.
+_curses_module = None
 
 
 def _unicode(s, encoding='utf-8'):
@@ -26,6 +24,10 @@ def terminal_get_size(default_size=(25, 80)):
     if they can be determined, or `default_size` if they can't.
     """
 
+    import fcntl
+    import struct
+    import termios
+
     def ioctl_gwinsz(fd):  # TABULATION FUNCTIONS
         try:  # Discover terminal width
             return struct.unpack(
@@ -76,8 +78,7 @@ def _terminal_use_capability(capability_name):
     If the terminal supports the given capability, output it.  Return whether
     it was output.
     """
-    curses.setupterm()
-    capability = curses.tigetstr(capability_name)
+    capability = _curses().tigetstr(capability_name)
     if capability:
         sys.stdout.write(_unicode(capability))
     return bool(capability)
@@ -96,10 +97,10 @@ def _terminal_set_color(color):
             color_index = possible_colors.split(' ').index(color)
         except ValueError:
             return None
-        set_code = curses.tigetstr(set_capability)
+        set_code = _curses().tigetstr(set_capability)
         if not set_code:
             return None
-        return curses.tparm(set_code, color_index)
+        return _curses().tparm(set_code, color_index)
     code = (
         color_code(
             'setaf', 'BLACK RED GREEN YELLOW BLUE MAGENTA CYAN WHITE'
@@ -113,6 +114,16 @@ def _terminal_set_color(color):
 
 
 def _terminal_restore_color():
-    restore_code = curses.tigetstr('sgr0')
+    restore_code = _curses().tigetstr('sgr0')
     if restore_code:
         sys.stdout.write(_unicode(restore_code))
+
+
+def _curses():
+    """Returns the curses module, setting up the terminal the first time."""
+    global _curses_module
+    if _curses_module is None:
+        import curses
+        curses.setupterm()
+        _curses_module = curses
+    return _curses_module
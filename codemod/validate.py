@@ -0,0 +1,127 @@
+"""
+Checks that the files a codemod changed still compile (or lint, or pass any
+other command), using a pool of workers so it scales with the number of
+changed files rather than the size of the tree.
+"""
+import multiprocessing
+import shlex
+import subprocess
+from multiprocessing.pool import ThreadPool
+
+try:
+    from shlex import quote as shell_quote
+except ImportError:
+    from pipes import quote as shell_quote
+
+
+def py_compile_validator(path):
+    r"""
+    Returns None if the file at `path` is valid Python, or the error message.
+    The file is compiled as bytes, so its encoding comes from its coding
+    declaration (or is UTF-8), not from the locale.
+
+    >>> py_compile_validator(__file__) is None
+    True
+    >>> import os, shutil, tempfile
+    >>> directory = tempfile.mkdtemp()
+    >>> path = os.path.join(directory, 'x.py')
+    >>> with open(path, 'wb') as file_w:
+    ...     _ = file_w.write(b'# -*- coding: utf-8 -*-\nx = "\xc3\xa9"\n')
+    >>> py_compile_validator(path) is None
+    True
+    >>> with open(path, 'wb') as file_w:
+    ...     _ = file_w.write(b'x = \n')
+    >>> py_compile_validator(path) is None
+    False
+    >>> shutil.rmtree(directory)
+    """
+    try:
+        with open(path, 'rb') as file_r:
+            compile(file_r.read(), path, 'exec')
+    except (SyntaxError, ValueError, TypeError) as error:
+        return str(error)
+    return None
+
+
+def command_validator(command):
+    """
+    Returns a validator that runs a shell command on each file, failing if it
+    exits with a non-zero status.  '{}' in the command is replaced with the
+    path; otherwise the path is added to the end.  It has a true
+    `runs_command` attribute, so validate waits on it from threads.
+
+    >>> command_validator('true')('x.php') is None
+    True
+    >>> print(command_validator('echo broken {}; false')('x.php'))
+    broken x.php
+    """
+    def validator(path):
+        if '{}' in command:
+            full_command = command.replace('{}', shell_quote(path))
+        else:
+            full_command = '%s %s' % (command, shell_quote(path))
+        process = subprocess.Popen(
+            full_command, shell=True,
+            stdout=subprocess.PIPE, stderr=subprocess.STDOUT
+        )
+        output = process.communicate()[0]
+        if process.returncode == 0:
+            return None
+        return output.decode('utf-8', 'replace').strip() or (
+            'exited with status %d' % process.returncode)
+    validator.runs_command = True
+    return validator
+
+
+def get_validator(spec):
+    """
+    Returns the validator described by `spec`: 'py_compile', or a shell
+    command for command_validator (e.g. 'php -l').
+    """
+    if spec == 'py_compile':
+        return py_compile_validator
+    if not shlex.split(spec):
+        raise ValueError('empty validator command')
+    return command_validator(spec)
+
+
+def validate(paths, validator, jobs=None):
+    """
+    Runs `validator` over `paths` in parallel, and returns a list of (path,
+    message) pairs for the files that failed, in the order of `paths`.
+    Validators that do the work in Python (and so hold the GIL) run in a
+    pool of processes, if they can be pickled; ones with a true
+    `runs_command` attribute just wait on commands, so they run in threads.
+
+    >>> validate(['a', 'b'], lambda path: 'bad' if path == 'b' else None)
+    [('b', 'bad')]
+    """
+    paths = list(paths)
+    if not paths:
+        return []
+    jobs = min(jobs or multiprocessing.cpu_count(), len(paths))
+    if jobs == 1:
+        messages = [validator(path) for path in paths]
+    else:
+        pool = _pool_for(validator, jobs)
+        try:
+            messages = pool.map(validator, paths)
+        finally:
+            pool.close()
+            pool.join()
+    return [
+        (path, message) for path, message in zip(paths, messages)
+        if message is not None
+    ]
+
+
+def _pool_for(validator, jobs):
+    if not getattr(validator, 'runs_command', False):
+        import pickle
+        try:
+            pickle.dumps(validator)
+        except (pickle.PicklingError, AttributeError, TypeError):
+            pass  # e.g. a lambda: threads will have to do
+        else:
+            return multiprocessing.Pool(jobs)
+    return ThreadPool(jobs)
@@ -0,0 +1,139 @@
+"""
+Lets several people work through the same codemod at once.  Each session
+claims one file at a time from a directory they all share, so nobody
+reviews a file someone else already has (or had), and files claimed by a
+session that went away are handed out again once its lease runs out.
+"""
+import hashlib
+import os
+import socket
+import time
+
+
+class WorkQueue(object):
+    """
+    A set of files, each unclaimed, leased to one session, or done, stored as
+    small marker files in a shared directory.
+
+    >>> import shutil, tempfile
+    >>> alice = WorkQueue(tempfile.mkdtemp(), owner='alice')
+    >>> bob = WorkQueue(alice.directory, owner='bob')
+    >>> alice.claim('a.php'), bob.claim('a.php'), bob.claim('b.php')
+    (True, False, True)
+    >>> alice.finish('a.php')
+    >>> bob.release('b.php')
+    >>> alice.claim('a.php'), alice.claim('b.php')
+    (False, True)
+
+    A lease that hasn't been renewed for lease_seconds can be taken over:
+
+    >>> carol = WorkQueue(alice.directory, lease_seconds=60, owner='carol')
+    >>> carol.claim('b.php')
+    False
+    >>> os.utime(alice._marker_path('b.php', '.lease'), (0, 0))
+    >>> carol.claim('b.php'), alice.claim('b.php')
+    (True, False)
+    >>> shutil.rmtree(alice.directory)
+    """
+
+    def __init__(self, directory, lease_seconds=30 * 60, owner=None):
+        """
+        @param directory      The shared directory.  Created if need be.
+        @param lease_seconds  How long a claim lasts without being renewed
+                              before another session may take the file.
+        @param owner          A name for this session.  Defaults to
+                              hostname:pid.
+        """
+        self.directory = directory
+        self.lease_seconds = lease_seconds
+        self.owner = owner or '%s:%d' % (socket.gethostname(), os.getpid())
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def _marker_path(self, key, suffix):
+        digest = hashlib.sha1(key.encode('utf-8')).hexdigest()
+        return os.path.join(self.directory, digest + suffix)
+
+    def claim(self, key):
+        """
+        Tries to lease the file identified by `key` to this session.  Returns
+        True if it did, or False if the file is done or leased to another
+        session.
+        """
+        if os.path.exists(self._marker_path(key, '.done')):
+            return False
+        lease_path = self._marker_path(key, '.lease')
+        if self._create(lease_path):
+            return True
+        if self._owns(lease_path):
+            return True
+
+        if not self._expired(lease_path):
+            return False
+        expired_path = '%s.%s.expired' % (lease_path, self.owner)
+        try:
+            os.rename(lease_path, expired_path)
+        except OSError:
+            if os.path.exists(lease_path):
+                return False
+        else:
+            if not self._expired(expired_path):
+                # Between our check and the rename, another session renamed
+                # the expired lease away and created a new one, and that's
+                # what we renamed: put it back.
+                try:
+                    os.link(expired_path, lease_path)
+                except OSError:
+                    pass
+                os.remove(expired_path)
+                return False
+            os.remove(expired_path)
+        # Creating the lease is exclusive, so if several sessions get here,
+        # only one wins.
+        return self._create(lease_path)
+
+    def _expired(self, lease_path):
+        try:
+            return (time.time() - os.path.getmtime(lease_path) >
+                    self.lease_seconds)
+        except OSError:
+            return True  # released in the meantime
+
+    def renew(self, key):
+        """Restarts the clock on this session's lease of `key`."""
+        try:
+            os.utime(self._marker_path(key, '.lease'), None)
+        except OSError:
+            pass
+
+    def finish(self, key):
+        """Marks the file identified by `key` as done."""
+        with open(self._marker_path(key, '.done'), 'w') as done_file:
+            done_file.write('%s\n%s\n' % (key, self.owner))
+        self.release(key)
+
+    def release(self, key):
+        """Gives up this session's lease of `key`, if it still holds it."""
+        lease_path = self._marker_path(key, '.lease')
+        if self._owns(lease_path):
+            try:
+                os.remove(lease_path)
+            except OSError:
+                pass
+
+    def _create(self, lease_path):
+        try:
+            lease_fd = os.open(
+                lease_path, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644)
+        except OSError:
+            return False
+        os.write(lease_fd, self.owner.encode('utf-8'))
+        os.close(lease_fd)
+        return True
+
+    def _owns(self, lease_path):
+        try:
+            with open(lease_path) as lease_file:
+                return lease_file.read() == self.owner
+        except IOError:
+            return False
@@ -0,0 +1,199 @@
+"""
+Writes files in the background, so that accepting a patch doesn't wait on
+the disk.
+"""
+import os
+import threading
+from collections import OrderedDict
+
+
+class WriteError(Exception):
+    """
+    Raised by WriteBehind for the files it failed to write.  `errors` maps
+    each of their paths to the exception writing it raised.
+    """
+
+    def __init__(self, errors):
+        super(WriteError, self).__init__(
+            'failed to write %d file(s):\n%s' % (len(errors), '\n'.join(
+                '%s: %r' % (path, error) for path, error in errors.items())))
+        self.errors = errors
+
+
+class WriteBehind(object):
+    """
+    Saves files from a background thread.  Saving the same file again before
+    the thread gets to it replaces the pending contents, so several patches
+    to one file become one rewrite, and each rewrite replaces the file
+    atomically (through a temporary file in the same directory).  Until a
+    file is written, read_lines returns the contents it's going to have.
+    With `binary`, files are read and written as bytes.
+
+    >>> import shutil, tempfile
+    >>> directory = tempfile.mkdtemp()
+    >>> path = os.path.join(directory, 'a.txt')
+    >>> open(path, 'w').close()
+    >>> writer = WriteBehind()
+    >>> writer.write(path, ['one\\n'])
+    >>> writer.write(path, ['one\\n', 'two\\n'])
+    >>> writer.read_lines(path)
+    ['one\\n', 'two\\n']
+    >>> writer.flush()
+    >>> open(path).read()
+    'one\\ntwo\\n'
+
+    Writes that fail don't stop the other files being written, and are all
+    reported by the next call to write or flush:
+
+    >>> paths = [os.path.join(directory, name) for name in ('b', 'c')]
+    >>> for other_path in paths:
+    ...     open(other_path, 'w').close()
+    ...     writer.write(other_path, ['written\\n'])
+    >>> writer.write(path, [1])
+    >>> try:
+    ...     writer.flush()
+    ... except WriteError as error:
+    ...     print(list(error.errors) == [path])
+    True
+    >>> [open(other_path).read() for other_path in paths]
+    ['written\\n', 'written\\n']
+    >>> writer.flush()
+    >>> shutil.rmtree(directory)
+    """
+
+    def __init__(self, binary=False):
+        self.binary = binary
+        self._pending = OrderedDict()  # path -> lines still to be written
+        self._writing = None  # (path, lines) being written right now
+        self._errors = OrderedDict()  # path -> error writing it
+        self._condition = threading.Condition()
+        self._thread = None
+
+    def write(self, path, lines):
+        """Saves `lines` as the contents of the file at `path`, eventually."""
+        with self._condition:
+            self._raise_error()
+            self._pending.pop(path, None)
+            self._pending[path] = list(lines)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run)
+                self._thread.daemon = True
+                self._thread.start()
+            self._condition.notify_all()
+
+    def read_lines(self, path):
+        """
+        Returns the lines of the file at `path`, as of the last call to
+        write, if it hasn't been written yet.
+        """
+        lines = self.pending_lines(path)
+        if lines is not None:
+            return lines
+        with open(path, 'rb' if self.binary else 'r') as file_r:
+            return list(file_r)
+
+    def pending_lines(self, path):
+        """
+        Returns a copy of the lines waiting to be written to `path`, or None
+        if there are none.
+        """
+        with self._condition:
+            if path in self._pending:
+                return list(self._pending[path])
+            if self._writing is not None and self._writing[0] == path:
+                return list(self._writing[1])
+        return None
+
+    def flush(self, path=None):
+        """
+        Waits until the file at `path` (or, by default, every file) has been
+        written.  Raises a WriteError for the writes that failed.
+        """
+        with self._condition:
+            while self._is_pending(path):
+                self._condition.wait()
+            self._raise_error()
+
+    def _is_pending(self, path):
+        if path is None:
+            return bool(self._pending) or self._writing is not None
+        return path in self._pending or (
+            self._writing is not None and self._writing[0] == path)
+
+    def _raise_error(self):
+        if self._errors:
+            errors, self._errors = self._errors, OrderedDict()
+            raise WriteError(errors)
+
+    def _run(self):
+        while True:
+            with self._condition:
+                while not self._pending:
+                    self._condition.wait()
+                self._writing = self._pending.popitem(last=False)
+            try:
+                _write_atomically(*self._writing, binary=self.binary)
+            except BaseException as error:
+                # Anything (e.g. a UnicodeEncodeError) is reported to whoever
+                # writes or flushes next, rather than ending the thread and
+                # leaving flush waiting forever.  The other files are still
+                # written.
+                with self._condition:
+                    self._errors[self._writing[0]] = error
+            finally:
+                with self._condition:
+                    self._writing = None
+                    self._condition.notify_all()
+
+
+def _write_atomically(path, lines, binary=False):
+    import tempfile
+    file_fd, temporary_path = tempfile.mkstemp(
+        prefix='.codemod-', dir=os.path.dirname(os.path.realpath(path)))
+    try:
+        with os.fdopen(file_fd, 'wb' if binary else 'w') as file_w:
+            file_w.writelines(lines)
+        replace_file(temporary_path, path)
+    except BaseException:
+        os.remove(temporary_path)
+        raise
+
+
+def replace_file(temporary_path, path):
+    """
+    Moves the file at `temporary_path` (which should be in the same
+    directory as the real file) into place at `path`, writing through
+    symlinks, and keeping the file's mode and any hard links to it.
+
+    >>> import shutil, tempfile
+    >>> directory = tempfile.mkdtemp()
+    >>> def write(name, text):
+    ...     with open(os.path.join(directory, name), 'w') as file_w:
+    ...         file_w.write(text)
+    ...     return os.path.join(directory, name)
+    >>> path = write('a', 'old')
+    >>> os.chmod(path, 0o751)
+    >>> os.link(path, path + '.hard')
+    >>> os.symlink(path, path + '.soft')
+    >>> replace_file(write('new', 'new'), path + '.soft')
+    >>> [open(path + suffix).read() for suffix in ('', '.hard', '.soft')]
+    ['new', 'new', 'new']
+    >>> os.path.islink(path + '.soft')
+    True
+    >>> os.remove(path + '.hard')
+    >>> replace_file(write('newer', 'newer'), path)
+    >>> open(path).read(), os.stat(path).st_mode & 0o777 == 0o751
+    ('newer', True)
+    >>> sorted(os.listdir(directory))
+    ['a', 'a.soft']
+    >>> shutil.rmtree(directory)
+    """
+    import shutil
+    path = os.path.realpath(path)
+    if os.stat(path).st_nlink > 1:
+        # Renaming would leave the other links with the old contents.
+        shutil.copyfile(temporary_path, path)
+        os.remove(temporary_path)
+    else:
+        shutil.copymode(path, temporary_path)
+        os.rename(temporary_path, path)